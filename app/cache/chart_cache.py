@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ChartCache:
+    """Кэш отрисованных графиков (PNG) в памяти.
+
+    Ключ включает водяной знак данных ресторана, поэтому после изменения данных
+    старые записи просто перестают запрашиваться и вытесняются по LRU в пределах
+    max_bytes. ttl ограничивает жизнь записи для изменений, которые знак не
+    отслеживает (например, переименование блюда).
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024, ttl: float = 3600.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (png, created_at)
+        self._entries: OrderedDict[tuple, tuple[bytes, float]] = OrderedDict()
+        self._bytes = 0
+        self._stats = {"hits": 0, "misses": 0, "puts": 0, "evicted": 0}
+
+    def _drop_locked(self, key: tuple) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[0])
+
+    def get(self, key: tuple) -> bytes | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.time() - self.ttl:
+                if entry is not None:
+                    self._drop_locked(key)
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key: tuple, png: bytes) -> None:
+        if len(png) > self.max_bytes:
+            return
+        with self._lock:
+            self._stats["puts"] += 1
+            self._drop_locked(key)
+            while self._entries and self._bytes + len(png) > self.max_bytes:
+                old_key = next(iter(self._entries))
+                self._drop_locked(old_key)
+                self._stats["evicted"] += 1
+            self._entries[key] = (png, time.time())
+            self._bytes += len(png)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            data = dict(self._stats)
+            data.update(entries=len(self._entries), bytes=self._bytes, max_bytes=self.max_bytes)
+        return data
+
+
+_cache: ChartCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_chart_cache() -> ChartCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ChartCache(
+                    max_bytes=int(float(os.environ.get("CHART_CACHE_MAX_MB", "32")) * 1024 * 1024),
+                    ttl=float(os.environ.get("CHART_CACHE_TTL", "3600")),
+                )
+    return _cache
@@ -0,0 +1,181 @@
+import os
+import pickle
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+_ID_RE = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+
+class ResultStore:
+    """Серверное хранилище результатов запросов.
+
+    В cookie-сессии остаётся только непрозрачный id. Результаты держатся в памяти
+    в пределах max_bytes с вытеснением по LRU; вытесненные при наличии spill_dir
+    сбрасываются на диск (тоже с ограничением объёма), иначе удаляются.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        spill_dir: str | None = None,
+        spill_max_bytes: int = 512 * 1024 * 1024,
+        ttl: float = 3600.0,
+    ):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # id -> (owner, payload, size, created_at)
+        self._memory: OrderedDict[str, tuple] = OrderedDict()
+        # id -> (owner, size, created_at)
+        self._disk: OrderedDict[str, tuple] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self._stats = {"puts": 0, "hits": 0, "disk_hits": 0, "misses": 0, "evicted": 0, "spilled": 0}
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def _spill_path(self, result_id: str) -> str:
+        return os.path.join(self.spill_dir, f"{result_id}.pkl")
+
+    def _drop_disk_locked(self, result_id: str) -> None:
+        entry = self._disk.pop(result_id, None)
+        if entry is None:
+            return
+        self._disk_bytes -= entry[1]
+        try:
+            os.remove(self._spill_path(result_id))
+        except OSError:
+            pass
+
+    def _drop_memory_locked(self, result_id: str):
+        entry = self._memory.pop(result_id, None)
+        if entry is not None:
+            self._memory_bytes -= entry[2]
+        return entry
+
+    def _spill_locked(self, result_id: str, owner: str, payload: dict, size: int, created_at: float) -> None:
+        if not self.spill_dir or size > self.spill_max_bytes:
+            self._stats["evicted"] += 1
+            return
+        while self._disk and self._disk_bytes + size > self.spill_max_bytes:
+            self._drop_disk_locked(next(iter(self._disk)))
+            self._stats["evicted"] += 1
+        try:
+            with open(self._spill_path(result_id), "wb") as f:
+                pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            self._stats["evicted"] += 1
+            return
+        self._disk[result_id] = (owner, size, created_at)
+        self._disk_bytes += size
+        self._stats["spilled"] += 1
+
+    def _expire_locked(self) -> None:
+        deadline = time.time() - self.ttl
+        for result_id in [rid for rid, e in self._memory.items() if e[3] < deadline]:
+            self._drop_memory_locked(result_id)
+        for result_id in [rid for rid, e in self._disk.items() if e[2] < deadline]:
+            self._drop_disk_locked(result_id)
+
+    def put(self, owner: str, cols: list[str], rows: list, meta: dict | None = None) -> str:
+        payload = {"cols": list(cols), "rows": list(rows), "meta": dict(meta or {})}
+        size = len(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+        result_id = secrets.token_urlsafe(18)
+        created_at = time.time()
+        with self._lock:
+            self._stats["puts"] += 1
+            self._expire_locked()
+            # результат больше всей памяти сразу уходит на диск, не вытесняя горячие записи
+            if size > self.max_bytes:
+                self._spill_locked(result_id, owner, payload, size, created_at)
+                return result_id
+            while self._memory and self._memory_bytes + size > self.max_bytes:
+                old_id, (old_owner, old_payload, old_size, old_created) = self._memory.popitem(last=False)
+                self._memory_bytes -= old_size
+                self._spill_locked(old_id, old_owner, old_payload, old_size, old_created)
+            self._memory[result_id] = (owner, payload, size, created_at)
+            self._memory_bytes += size
+        return result_id
+
+    def get(self, result_id: str, owner: str) -> dict | None:
+        if not result_id or not _ID_RE.match(result_id):
+            return None
+        with self._lock:
+            entry = self._memory.get(result_id)
+            if entry is not None:
+                if entry[0] != owner:
+                    self._stats["misses"] += 1
+                    return None
+                self._memory.move_to_end(result_id)
+                self._stats["hits"] += 1
+                return entry[1]
+            disk_entry = self._disk.get(result_id)
+            if disk_entry is None or disk_entry[0] != owner:
+                self._stats["misses"] += 1
+                return None
+            try:
+                with open(self._spill_path(result_id), "rb") as f:
+                    payload = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                self._drop_disk_locked(result_id)
+                self._stats["misses"] += 1
+                return None
+            self._stats["disk_hits"] += 1
+            return payload
+
+    def page(self, result_id: str, owner: str, page: int, page_size: int) -> dict | None:
+        payload = self.get(result_id, owner)
+        if payload is None:
+            return None
+        total = len(payload["rows"])
+        pages = max((total + page_size - 1) // page_size, 1)
+        page = min(max(page, 1), pages)
+        start = (page - 1) * page_size
+        return {
+            "cols": payload["cols"],
+            "rows": payload["rows"][start:start + page_size],
+            "meta": payload["meta"],
+            "page": page,
+            "pages": pages,
+            "total": total,
+        }
+
+    def delete(self, result_id: str) -> None:
+        with self._lock:
+            self._drop_memory_locked(result_id)
+            self._drop_disk_locked(result_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            data = dict(self._stats)
+            data.update(
+                memory_entries=len(self._memory),
+                memory_bytes=self._memory_bytes,
+                disk_entries=len(self._disk),
+                disk_bytes=self._disk_bytes,
+                max_bytes=self.max_bytes,
+            )
+        return data
+
+
+_store: ResultStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_result_store() -> ResultStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ResultStore(
+                    max_bytes=int(float(os.environ.get("RESULT_STORE_MAX_MB", "64")) * 1024 * 1024),
+                    spill_dir=os.environ.get("RESULT_STORE_SPILL_DIR") or None,
+                    spill_max_bytes=int(float(os.environ.get("RESULT_STORE_SPILL_MAX_MB", "512")) * 1024 * 1024),
+                    ttl=float(os.environ.get("RESULT_STORE_TTL", "3600")),
+                )
+    return _store
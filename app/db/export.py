@@ -0,0 +1,112 @@
+import csv
+import io
+import json
+import os
+import uuid
+import zlib
+
+from app.db.pool import get_pool
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def _encode_csv(cols: list[str] | None, rows: list[tuple]) -> str:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if cols is not None:
+        writer.writerow(cols)
+    writer.writerows(rows)
+    return buf.getvalue()
+
+
+def _encode_ndjson(cols: list[str], rows: list[tuple]) -> str:
+    return "".join(
+        json.dumps(dict(zip(cols, row)), ensure_ascii=False, default=str) + "\n" for row in rows
+    )
+
+
+def stream_export(
+    sql: str,
+    params: list | tuple | None = None,
+    fmt: str = "csv",
+    compress: bool = False,
+    header: list[str] | None = None,
+    itersize: int | None = None,
+):
+    """Выполняет SELECT на именованном (серверном) курсоре и отдаёт результат частями.
+
+    Запрос выполняется и первая пачка читается сразу, чтобы ошибки SQL можно было
+    вернуть обычным ответом до начала стриминга. Соединение остаётся занятым, пока
+    генератор не будет исчерпан или закрыт.
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    itersize = itersize or int(os.environ.get("EXPORT_ITERSIZE", "2000"))
+    pool = get_pool()
+    conn = pool.getconn()
+    cur = None
+    try:
+        cur = conn.cursor(name=f"export_{uuid.uuid4().hex}")
+        cur.itersize = itersize
+        cur.execute(sql, params)
+        first = cur.fetchmany(itersize)
+        cols = [d.name for d in cur.description]
+    except Exception:
+        if cur is not None:
+            try:
+                cur.close()
+            except Exception:
+                pass
+        conn.rollback()
+        pool.putconn(conn)
+        raise
+
+    def generate():
+        compressor = zlib.compressobj(wbits=31) if compress else None
+
+        def emit(text: str) -> bytes:
+            data = text.encode("utf-8")
+            return compressor.compress(data) if compressor else data
+
+        try:
+            batch = first
+            if fmt == "csv":
+                chunk = emit(_encode_csv(header or cols, batch))
+            else:
+                chunk = emit(_encode_ndjson(header or cols, batch))
+            while True:
+                if chunk:
+                    yield chunk
+                if len(batch) < itersize:
+                    break
+                batch = cur.fetchmany(itersize)
+                if not batch:
+                    break
+                if fmt == "csv":
+                    chunk = emit(_encode_csv(None, batch))
+                else:
+                    chunk = emit(_encode_ndjson(header or cols, batch))
+            if compressor:
+                yield compressor.flush()
+        finally:
+            try:
+                cur.close()
+                conn.rollback()
+            except Exception:
+                pool.putconn(conn, close=True)
+            else:
+                pool.putconn(conn)
+
+    return generate()
+
+
+def export_filename(base: str, fmt: str, compress: bool) -> str:
+    name = f"{base}.{fmt}"
+    return f"{name}.gz" if compress else name
+
+
+def export_mimetype(fmt: str, compress: bool) -> str:
+    return "application/gzip" if compress else EXPORT_FORMATS[fmt]
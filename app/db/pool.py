@@ -0,0 +1,256 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с PostgreSQL.
+
+    Соединения выдаются по принципу LIFO, перед выдачей проверяются,
+    простаивающие сверх min_size закрываются по idle_timeout.
+    """
+
+    def __init__(
+        self,
+        min_size: int = 1,
+        max_size: int = 10,
+        timeout: float = 10.0,
+        idle_timeout: float = 300.0,
+        check_interval: float = 30.0,
+        **connect_kwargs,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Недопустимые размеры пула: min={min_size}, max={max_size}")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self._connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._idle: list[tuple[extensions.connection, float]] = []
+        self._size = 0
+        self._in_use = 0
+        self._pid = os.getpid()
+        self._last_reap = time.monotonic()
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "timeouts": 0,
+            "connections_created": 0,
+            "connections_closed": 0,
+            "health_check_failures": 0,
+            "reaped": 0,
+        }
+
+    def _connect(self) -> extensions.connection:
+        conn = psycopg2.connect(**self._connect_kwargs)
+        with self._cond:
+            self._stats["connections_created"] += 1
+        return conn
+
+    def _discard(self, conn: extensions.connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._stats["connections_closed"] += 1
+
+    def _check_fork(self) -> None:
+        # после fork() сокеты родителя использовать нельзя: просто забываем их
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._size = 0
+            self._in_use = 0
+
+    def _is_healthy(self, conn: extensions.connection, idle_since: float) -> bool:
+        if conn.closed:
+            return False
+        if conn.info.transaction_status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _reap_locked(self) -> None:
+        now = time.monotonic()
+        if now - self._last_reap < min(self.idle_timeout, 30.0):
+            return
+        self._last_reap = now
+        keep = []
+        excess = self._size - self.min_size
+        # самые старые соединения лежат в начале стека
+        for conn, idle_since in self._idle:
+            if excess > 0 and now - idle_since > self.idle_timeout:
+                self._discard(conn)
+                self._size -= 1
+                self._stats["reaped"] += 1
+                excess -= 1
+            else:
+                keep.append((conn, idle_since))
+        self._idle = keep
+
+    def getconn(self) -> extensions.connection:
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        wait_started = None
+        while True:
+            conn = None
+            idle_since = 0.0
+            with self._cond:
+                if self._closed:
+                    raise PoolError("Пул соединений закрыт")
+                self._check_fork()
+                self._reap_locked()
+                while not self._idle and self._size >= self.max_size:
+                    if not waited:
+                        waited = True
+                        wait_started = time.monotonic()
+                        self._stats["waits"] += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolError(
+                            f"Нет свободных соединений в пуле (max={self.max_size}) за {self.timeout} с"
+                        )
+                    self._cond.wait(remaining)
+                if wait_started is not None:
+                    self._stats["wait_time_total"] += time.monotonic() - wait_started
+                    wait_started = None
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    self._size += 1
+                self._in_use += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._in_use -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn, idle_since):
+                with self._cond:
+                    self._stats["health_check_failures"] += 1
+                    self._discard(conn)
+                    self._size -= 1
+                    self._in_use -= 1
+                    self._cond.notify()
+                continue
+
+            with self._cond:
+                self._stats["checkouts"] += 1
+            return conn
+
+    def putconn(self, conn: extensions.connection, close: bool = False) -> None:
+        if not conn.closed and not close:
+            try:
+                if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit:
+                    conn.autocommit = False
+            except Exception:
+                close = True
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if conn.closed or close or self._closed:
+                self._discard(conn)
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Аналог `with psycopg2.connect() as conn`: commit при успехе, rollback при ошибке."""
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+            if not conn.closed:
+                conn.commit()
+        except BaseException:
+            try:
+                if not conn.closed:
+                    conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def prefill(self) -> None:
+        conns = []
+        with self._cond:
+            missing = self.min_size - self._size
+        try:
+            for _ in range(max(missing, 0)):
+                conns.append(self.getconn())
+        finally:
+            for conn in conns:
+                self.putconn(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            data = dict(self._stats)
+            data.update(
+                size=self._size,
+                idle=len(self._idle),
+                in_use=self._in_use,
+                min_size=self.min_size,
+                max_size=self.max_size,
+            )
+        data["wait_time_total"] = round(data["wait_time_total"], 4)
+        return data
+
+    def closeall(self) -> None:
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._size -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    min_size=int(os.environ.get("DB_POOL_MIN", "1")),
+                    max_size=int(os.environ.get("DB_POOL_MAX", "10")),
+                    timeout=float(os.environ.get("DB_POOL_TIMEOUT", "10")),
+                    idle_timeout=float(os.environ.get("DB_POOL_IDLE_TIMEOUT", "300")),
+                    check_interval=float(os.environ.get("DB_POOL_CHECK_INTERVAL", "30")),
+                    host=os.environ.get("DB_HOST", "localhost"),
+                    port=os.environ.get("DB_PORT", "5432"),
+                    dbname=os.environ.get("DB_NAME", "restaurant_management"),
+                    user=os.environ.get("DB_USER", "restaurant_admin"),
+                    password=os.environ.get("DB_PASSWORD", "secure_password_123"),
+                )
+    return _pool
@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+
+from psycopg2.extras import RealDictCursor
+
+from app.db.pool import get_pool
+
+CATALOG_SQL = """
+    SELECT
+        t.table_name,
+        c.column_name,
+        c.data_type,
+        c.is_nullable,
+        c.column_default,
+        c.is_identity
+    FROM information_schema.tables t
+    LEFT JOIN information_schema.columns c
+        ON c.table_schema = t.table_schema AND c.table_name = t.table_name
+    WHERE t.table_schema = 'public' AND t.table_type = 'BASE TABLE'
+    ORDER BY t.table_name, c.ordinal_position
+"""
+
+PRIMARY_KEYS_SQL = """
+    SELECT c.relname AS table_name, a.attname AS column_name
+    FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indrelid
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = ANY(i.indkey)
+    WHERE i.indisprimary AND c.relnamespace = 'public'::regnamespace
+    ORDER BY c.relname, array_position(i.indkey::int2[], a.attnum)
+"""
+
+# Любой DDL в схеме public меняет строки pg_class/pg_attribute, а значит и их xmin
+VERSION_SQL = """
+    SELECT
+        (SELECT COUNT(*) FROM pg_class WHERE relnamespace = 'public'::regnamespace) AS relations,
+        (SELECT COALESCE(MAX(xmin::text::bigint), 0) FROM pg_class
+         WHERE relnamespace = 'public'::regnamespace) AS class_xmin,
+        (SELECT COALESCE(MAX(a.xmin::text::bigint), 0) FROM pg_attribute a
+         JOIN pg_class c ON c.oid = a.attrelid
+         WHERE c.relnamespace = 'public'::regnamespace) AS attr_xmin
+"""
+
+
+class SchemaCatalog:
+    """Кэш таблиц и колонок схемы public.
+
+    Данные живут ttl секунд; по истечении сначала сверяется версия каталога
+    pg_catalog и полная перезагрузка выполняется только если схема изменилась.
+    """
+
+    def __init__(self, get_conn, ttl: float = 60.0, miss_recheck_interval: float = 1.0):
+        self._get_conn = get_conn
+        self.ttl = ttl
+        self.miss_recheck_interval = miss_recheck_interval
+        self._lock = threading.Lock()
+        self._tables: dict[str, list[dict]] = {}
+        self._column_names: dict[str, frozenset[str]] = {}
+        self._primary_keys: dict[str, list[str]] = {}
+        self._version = None
+        self._expires_at = 0.0
+        self._last_check = 0.0
+        self.stats = {"loads": 0, "version_checks": 0, "hits": 0}
+
+    def _fetch_version(self, cur) -> tuple:
+        cur.execute(VERSION_SQL)
+        row = cur.fetchone()
+        return tuple(row.values()) if isinstance(row, dict) else tuple(row)
+
+    def _load(self) -> None:
+        with self._get_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            version = self._fetch_version(cur)
+            cur.execute(CATALOG_SQL)
+            rows = cur.fetchall()
+            cur.execute(PRIMARY_KEYS_SQL)
+            pk_rows = cur.fetchall()
+        tables: dict[str, list[dict]] = {}
+        for row in rows:
+            columns = tables.setdefault(row.pop("table_name"), [])
+            if row["column_name"] is None:
+                continue
+            default = row.get("column_default") or ""
+            row["is_serial"] = default.startswith("nextval(") or row.get("is_identity") == "YES"
+            columns.append(dict(row))
+        primary_keys: dict[str, list[str]] = {}
+        for row in pk_rows:
+            primary_keys.setdefault(row["table_name"], []).append(row["column_name"])
+        self._tables = tables
+        self._primary_keys = primary_keys
+        self._column_names = {
+            name: frozenset(col["column_name"] for col in cols) for name, cols in tables.items()
+        }
+        self._version = version
+        self.stats["loads"] += 1
+
+    def _refresh(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now < self._expires_at:
+            self.stats["hits"] += 1
+            return
+        with self._lock:
+            now = time.monotonic()
+            if not force and now < self._expires_at:
+                return
+            if self._version is None or force:
+                self._load()
+            else:
+                self.stats["version_checks"] += 1
+                with self._get_conn() as conn, conn.cursor() as cur:
+                    version = self._fetch_version(cur)
+                if version != self._version:
+                    self._load()
+            self._last_check = time.monotonic()
+            self._expires_at = self._last_check + self.ttl
+
+    def _recheck_on_miss(self) -> None:
+        # новая таблица могла появиться до истечения ttl — сверяем версию, но не чаще интервала
+        if time.monotonic() - self._last_check >= self.miss_recheck_interval:
+            self._expires_at = 0.0
+            self._refresh()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._version = None
+            self._expires_at = 0.0
+
+    def tables(self) -> list[str]:
+        self._refresh()
+        return sorted(self._tables)
+
+    def has_table(self, table: str) -> bool:
+        self._refresh()
+        if table in self._tables:
+            return True
+        self._recheck_on_miss()
+        return table in self._tables
+
+    def columns(self, table: str) -> list[dict]:
+        if not self.has_table(table):
+            raise KeyError(table)
+        return [dict(col) for col in self._tables[table]]
+
+    def column_names(self, table: str) -> frozenset[str]:
+        if not self.has_table(table):
+            raise KeyError(table)
+        return self._column_names[table]
+
+    def primary_key(self, table: str) -> list[str]:
+        if not self.has_table(table):
+            raise KeyError(table)
+        return list(self._primary_keys.get(table, []))
+
+    def serial_columns(self, table: str) -> list[str]:
+        return [col["column_name"] for col in self.columns(table) if col["is_serial"]]
+
+
+_catalog: SchemaCatalog | None = None
+_catalog_lock = threading.Lock()
+
+
+def get_schema_catalog() -> SchemaCatalog:
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = SchemaCatalog(
+                    lambda: get_pool().connection(),
+                    ttl=float(os.environ.get("SCHEMA_CACHE_TTL", "60")),
+                )
+    return _catalog
@@ -0,0 +1,119 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+# границы корзин гистограмм, секунды
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        result, running = [], 0
+        for bound, count in zip([*map(str, self.buckets), "+Inf"], self.counts):
+            running += count
+            result.append((bound, running))
+        return result
+
+
+class GuardMetrics:
+    """Время работы слоёв SQL guard, счётчик решающих слоёв и выборка медленных запросов."""
+
+    def __init__(self, slow_threshold: float = 0.05, slow_samples: int = 50, enabled: bool = True):
+        self.slow_threshold = slow_threshold
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._layers: dict[str, Histogram] = {}
+        self._decided: dict[tuple[str, bool], int] = {}
+        self._slow = deque(maxlen=slow_samples)
+
+    def record(self, sql: str, verdict: dict, timings: dict[str, float], total: float, cached: bool = False) -> None:
+        if not self.enabled:
+            return
+        layer = "cache" if cached else verdict.get("layer", "ml")
+        with self._lock:
+            for name, elapsed in timings.items():
+                self._layers.setdefault(name, Histogram()).observe(elapsed)
+            self._layers.setdefault("total", Histogram()).observe(total)
+            key = (layer, bool(verdict.get("allowed")))
+            self._decided[key] = self._decided.get(key, 0) + 1
+            if total >= self.slow_threshold:
+                self._slow.append({
+                    "at": time.time(),
+                    "sql": sql[:500],
+                    "total_ms": round(total * 1000, 3),
+                    "layers_ms": {name: round(t * 1000, 3) for name, t in timings.items()},
+                    "layer": layer,
+                    "allowed": bool(verdict.get("allowed")),
+                })
+
+    def observe_layer(self, name: str, elapsed: float) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._layers.setdefault(name, Histogram()).observe(elapsed)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._layers.clear()
+            self._decided.clear()
+            self._slow.clear()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "layers": {
+                    name: {
+                        "count": h.count,
+                        "sum_seconds": round(h.total, 6),
+                        "avg_ms": round(h.total / h.count * 1000, 4) if h.count else 0.0,
+                        "buckets": dict(h.cumulative()),
+                    }
+                    for name, h in self._layers.items()
+                },
+                "decided": [
+                    {"layer": layer, "allowed": allowed, "count": count}
+                    for (layer, allowed), count in sorted(self._decided.items())
+                ],
+                "slow_threshold_ms": self.slow_threshold * 1000,
+                "slow_queries": list(self._slow),
+            }
+
+    def to_prometheus(self) -> str:
+        lines = [
+            "# HELP sql_guard_layer_seconds Time spent in each SQL guard layer",
+            "# TYPE sql_guard_layer_seconds histogram",
+        ]
+        with self._lock:
+            for name, h in sorted(self._layers.items()):
+                for bound, count in h.cumulative():
+                    lines.append(f'sql_guard_layer_seconds_bucket{{layer="{name}",le="{bound}"}} {count}')
+                lines.append(f'sql_guard_layer_seconds_sum{{layer="{name}"}} {h.total:.9f}')
+                lines.append(f'sql_guard_layer_seconds_count{{layer="{name}"}} {h.count}')
+            lines += [
+                "# HELP sql_guard_decisions_total Verdicts by the layer that decided them",
+                "# TYPE sql_guard_decisions_total counter",
+            ]
+            for (layer, allowed), count in sorted(self._decided.items()):
+                outcome = "allowed" if allowed else "blocked"
+                lines.append(f'sql_guard_decisions_total{{layer="{layer}",outcome="{outcome}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+guard_metrics = GuardMetrics(
+    slow_threshold=float(os.environ.get("SQL_GUARD_SLOW_MS", "50")) / 1000,
+    slow_samples=int(os.environ.get("SQL_GUARD_SLOW_SAMPLES", "50")),
+    enabled=os.environ.get("SQL_GUARD_METRICS", "true").lower() == "true",
+)
@@ -0,0 +1,113 @@
+import re
+import struct
+import zipfile
+from collections import Counter
+
+import numpy as np
+
+from app.security.query_features import FEATURE_NAMES, extract_features_batch
+
+_WHITE_SPACES = re.compile(r"\s\s+")
+
+
+def load_npz_mmap(path: str) -> dict[str, np.ndarray]:
+    """Открывает несжатый .npz через mmap: массивы не копируются в память процесса,
+    страницы файла делятся между воркерами через page cache."""
+    arrays = {}
+    with zipfile.ZipFile(path) as zf, open(path, "rb") as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{path}: массив {info.filename} сжат, mmap невозможен")
+            f.seek(info.header_offset)
+            name_len, extra_len = struct.unpack("<HH", f.read(30)[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = info.filename[:-4] if info.filename.endswith(".npy") else info.filename
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(
+                path, dtype=dtype, mode="r", offset=f.tell(), shape=shape,
+                order="F" if fortran_order else "C",
+            )
+    return arrays
+
+
+class LinearSQLScorer:
+    """Скорер, эквивалентный пайплайну char TF-IDF + признаки запроса ->
+    StandardScaler(with_mean=False) -> LogisticRegression.
+
+    Параметры берутся из .npz, созданного ml_export.export_pipeline; sklearn,
+    scipy и pandas не нужны. Интерфейс predict_proba совпадает с пайплайном.
+    """
+
+    def __init__(self, arrays: dict[str, np.ndarray]):
+        self.vocab = arrays["vocab"]
+        self.idf = arrays["idf"]
+        self.tfidf_inv_scale = arrays["tfidf_inv_scale"]
+        self.tfidf_coef = arrays["tfidf_coef"]
+        self.stats_inv_scale = arrays["stats_inv_scale"]
+        self.stats_coef = arrays["stats_coef"]
+        self.intercept = float(arrays["intercept"][0])
+        self.ngram_min, self.ngram_max = (int(n) for n in arrays["ngram_range"])
+        self.lowercase = bool(arrays["lowercase"][0])
+        self.tfidf_weight, self.stats_weight = (float(w) for w in arrays["union_weights"])
+        if len(self.stats_coef) and len(self.stats_coef) != len(FEATURE_NAMES):
+            raise ValueError("Число признаков модели не совпадает с FEATURE_NAMES")
+
+    @classmethod
+    def load(cls, path: str) -> "LinearSQLScorer":
+        return cls(load_npz_mmap(path))
+
+    def _char_ngrams(self, text: str) -> list[str]:
+        # повторяет TfidfVectorizer(analyzer="char")._char_ngrams
+        if self.lowercase:
+            text = text.lower()
+        text = _WHITE_SPACES.sub(" ", text)
+        text_len = len(text)
+        min_n = self.ngram_min
+        ngrams = []
+        if min_n == 1:
+            ngrams = list(text)
+            min_n += 1
+        for n in range(min_n, min(self.ngram_max + 1, text_len + 1)):
+            for i in range(text_len - n + 1):
+                ngrams.append(text[i:i + n])
+        return ngrams
+
+    def decision_function(self, sqls: list[str]) -> np.ndarray:
+        doc_ids, terms, counts = [], [], []
+        for doc_id, sql in enumerate(sqls):
+            for term, count in Counter(self._char_ngrams(sql)).items():
+                doc_ids.append(doc_id)
+                terms.append(term)
+                counts.append(count)
+
+        n_docs = len(sqls)
+        scores = np.full(n_docs, self.intercept)
+        if terms:
+            terms = np.array(terms, dtype=self.vocab.dtype)
+            idx = np.searchsorted(self.vocab, terms)
+            idx[idx == len(self.vocab)] = 0
+            known = self.vocab[idx] == terms
+            idx = idx[known]
+            docs = np.asarray(doc_ids)[known]
+            values = np.asarray(counts, dtype=np.float64)[known] * self.idf[idx]
+            norms = np.sqrt(np.bincount(docs, weights=values * values, minlength=n_docs))
+            norms[norms == 0.0] = 1.0
+            values = values / norms[docs] * self.tfidf_weight * self.tfidf_inv_scale[idx]
+            scores += np.bincount(docs, weights=values * self.tfidf_coef[idx], minlength=n_docs)
+
+        if len(self.stats_coef):
+            stats = extract_features_batch(sqls)
+            scores += (stats * self.stats_weight * self.stats_inv_scale) @ self.stats_coef
+        return scores
+
+    def predict_proba(self, sqls: list[str]) -> np.ndarray:
+        with np.errstate(over="ignore"):
+            proba = 1.0 / (1.0 + np.exp(-self.decision_function(list(sqls))))
+        return np.column_stack([1.0 - proba, proba])
@@ -0,0 +1,84 @@
+import sys
+
+import numpy as np
+
+from app.security.query_features import FEATURE_NAMES
+
+
+def _split_pipeline(pipeline):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import FeatureUnion
+    from sklearn.preprocessing import StandardScaler
+
+    steps = [step for _, step in pipeline.steps if step not in (None, "passthrough")]
+    if len(steps) not in (2, 3) or not isinstance(steps[-1], LogisticRegression):
+        raise ValueError("Ожидается пайплайн признаки -> [StandardScaler] -> LogisticRegression")
+    features, clf = steps[0], steps[-1]
+    scaler = steps[1] if len(steps) == 3 else None
+    if scaler is not None and (not isinstance(scaler, StandardScaler) or scaler.with_mean):
+        raise ValueError("Поддерживается только StandardScaler(with_mean=False)")
+    if len(clf.classes_) != 2:
+        raise ValueError("Поддерживается только бинарная LogisticRegression")
+
+    if isinstance(features, TfidfVectorizer):
+        tfidf, stats, weights = features, None, {}
+    elif isinstance(features, FeatureUnion):
+        parts = [(name, t) for name, t in features.transformer_list if t not in (None, "drop")]
+        if len(parts) not in (1, 2) or not isinstance(parts[0][1], TfidfVectorizer):
+            raise ValueError("FeatureUnion должен содержать TfidfVectorizer и, опционально, FeatureExtractor")
+        tfidf = parts[0][1]
+        stats = parts[1][1] if len(parts) == 2 else None
+        weights = features.transformer_weights or {}
+        weights = {"tfidf": weights.get(parts[0][0], 1.0), "stats": weights.get(parts[1][0], 1.0) if stats else 1.0}
+    else:
+        raise ValueError(f"Неподдерживаемый шаг признаков: {type(features).__name__}")
+
+    if (
+        tfidf.analyzer != "char"
+        or tfidf.preprocessor is not None
+        or tfidf.strip_accents is not None
+        or tfidf.sublinear_tf
+        or tfidf.norm != "l2"
+        or tfidf.binary
+    ):
+        raise ValueError("Поддерживается только TfidfVectorizer(analyzer='char', norm='l2') без доп. обработки")
+    return tfidf, stats, scaler, clf, weights
+
+
+def export_pipeline(pipeline, path: str) -> None:
+    """Сохраняет обученный пайплайн в несжатый .npz для LinearSQLScorer."""
+    tfidf, stats, scaler, clf, weights = _split_pipeline(pipeline)
+    n_tfidf = len(tfidf.vocabulary_)
+    n_stats = len(FEATURE_NAMES) if stats is not None else 0
+    coef = clf.coef_[0].astype(np.float64)
+    if len(coef) != n_tfidf + n_stats:
+        raise ValueError(f"Размер coef_ ({len(coef)}) не совпадает с числом признаков ({n_tfidf + n_stats})")
+    inv_scale = 1.0 / scaler.scale_ if scaler is not None and scaler.scale_ is not None else np.ones(len(coef))
+    idf = tfidf.idf_ if tfidf.use_idf else np.ones(n_tfidf)
+
+    # словарь хранится отсортированным, чтобы искать n-граммы через searchsorted
+    terms = sorted(tfidf.vocabulary_)
+    order = np.array([tfidf.vocabulary_[t] for t in terms], dtype=np.int64)
+    np.savez(
+        path,
+        vocab=np.array(terms, dtype=f"<U{tfidf.ngram_range[1]}"),
+        idf=np.asarray(idf, dtype=np.float64)[order],
+        tfidf_inv_scale=inv_scale[:n_tfidf][order],
+        tfidf_coef=coef[:n_tfidf][order],
+        stats_inv_scale=inv_scale[n_tfidf:],
+        stats_coef=coef[n_tfidf:],
+        intercept=np.array([clf.intercept_[0]], dtype=np.float64),
+        ngram_range=np.array(tfidf.ngram_range, dtype=np.int64),
+        lowercase=np.array([tfidf.lowercase]),
+        union_weights=np.array([weights.get("tfidf", 1.0), weights.get("stats", 1.0)], dtype=np.float64),
+    )
+
+
+if __name__ == "__main__":
+    import joblib
+
+    source = sys.argv[1] if len(sys.argv) > 1 else "sql_injection_model.pkl"
+    target = sys.argv[2] if len(sys.argv) > 2 else "sql_injection_model.npz"
+    export_pipeline(joblib.load(source), target)
+    print(f"Модель {source} экспортирована в {target}")
@@ -1,16 +1,47 @@
-import joblib
+import os
 import threading
 import re
 
+from app.security.rule_engine import RuleSet
+
+SUSPICIOUS_PATTERNS = [
+    r"union.*select",
+    r"or\s+1\s*=\s*1",
+    r"and\s+1\s*=\s*1",
+    r"exec\s*\(",
+    r"execute\s*\(",
+    r"pg_sleep",
+    r"sleep\s*\(",
+    r"information_schema",
+    r"0x[0-9a-f]+",
+    r"--",
+    r"/\*",
+]
+
+SUSPICIOUS_RULES = RuleSet(SUSPICIOUS_PATTERNS, re.IGNORECASE)
+
 class MLSQLGuard:
     _instance = None
     _lock = threading.Lock()
 
     def __init__(self):
-        self.model = joblib.load("sql_injection_model.pkl")
+        self.model = self._load_model()
         self.threshold = 0.7367346938775511
         self.strict_threshold = 0.65
 
+    @staticmethod
+    def _load_model():
+        # экспортированная модель (.npz, см. ml_export.py) грузится за миллисекунды
+        # и без sklearn; pickle пайплайна — запасной вариант
+        path = os.environ.get("SQL_GUARD_MODEL")
+        if path is None:
+            path = "sql_injection_model.npz" if os.path.exists("sql_injection_model.npz") else "sql_injection_model.pkl"
+        if path.endswith(".npz"):
+            from app.security.linear_scorer import LinearSQLScorer
+            return LinearSQLScorer.load(path)
+        import joblib
+        return joblib.load(path)
+
     @classmethod
     def instance(cls):
         if not cls._instance:
@@ -22,23 +53,8 @@ class MLSQLGuard:
     def _has_suspicious_features(self, sql: str) -> bool:
         s = sql.lower()
         
-        suspicious = [
-            r"union.*select",
-            r"or\s+1\s*=\s*1",
-            r"and\s+1\s*=\s*1",
-            r"exec\s*\(",
-            r"execute\s*\(",
-            r"pg_sleep",
-            r"sleep\s*\(",
-            r"information_schema",
-            r"0x[0-9a-f]+",
-            r"--",
-            r"/\*",
-        ]
-        
-        for pattern in suspicious:
-            if re.search(pattern, s, re.IGNORECASE):
-                return True
+        if SUSPICIOUS_RULES.matches(s):
+            return True
         
         special_chars = sum(1 for c in sql if c in "()[]{}\"'`;")
         if special_chars > 20:
@@ -57,3 +73,18 @@ class MLSQLGuard:
             return is_malicious, proba
         except Exception as e:
             return True, 1.0
+
+    def check_many(self, sqls: list[str]) -> list[tuple[bool, float]]:
+        """Пакетный вариант check: один вызов predict_proba на весь список."""
+        if not sqls:
+            return []
+        try:
+            probas = self.model.predict_proba(list(sqls))[:, 1]
+        except Exception:
+            # модель не смогла обработать пакет целиком — оцениваем по одному
+            return [self.check(sql) for sql in sqls]
+        results = []
+        for sql, proba in zip(sqls, probas):
+            threshold = self.strict_threshold if self._has_suspicious_features(sql) else self.threshold
+            results.append((proba >= threshold, proba))
+        return results
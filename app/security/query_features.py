@@ -0,0 +1,122 @@
+import re
+
+# Признаки запроса для ML-модели. Модуль не зависит от pandas/sklearn, чтобы
+# экспортированный скорер (linear_scorer.py) не тянул их в веб-воркер.
+
+SQL_KEYWORDS = [
+    "select", "union", "insert", "update", "delete",
+    "drop", "sleep", "pg_sleep", "benchmark",
+    "--", "/*", "*/", ";",
+    "or", "and", "information_schema"
+]
+
+FEATURE_NAMES = [
+    "length",
+    "num_quotes",
+    "num_comments",
+    "num_semicolons",
+    "has_union",
+    "has_or_true",
+    "num_keywords",
+    "special_char_ratio",
+    "num_sleep",
+    "num_subqueries",
+]
+
+def extract_features(query: str):
+    q = str(query).lower()
+    num_keywords = sum(1 for k in SQL_KEYWORDS if k in q)
+    return {
+        "length": len(q),
+        "num_quotes": q.count("'") + q.count('"'),
+        "num_comments": len(re.findall(r"--|/\*|\*/", q)),
+        "num_semicolons": q.count(";"),
+        "has_union": int("union select" in q),
+        "has_or_true": int(bool(re.search(r"or\s+1\s*=\s*1", q))),
+        "num_keywords": num_keywords,
+        "special_char_ratio": sum(c in "'\";-" for c in q) / max(len(q), 1),
+        "num_sleep": int(bool(re.search(r"sleep|pg_sleep|benchmark", q))),
+        "num_subqueries": q.count("(") - q.count(")")
+    }
+
+
+_COMMENT_RE = re.compile(r"--|/\*|\*/")
+_OR_TRUE_RE = re.compile(r"or\s+1\s*=\s*1")
+_BATCH_CHUNK = 20000
+
+
+def _substring_docs(buf, doc_ids, pattern: str):
+    """Номера документов, в которых встречается pattern (buf — коды символов)."""
+    import numpy as np
+
+    codes = [ord(c) for c in pattern]
+    size = len(buf) - len(codes) + 1
+    if size <= 0:
+        return doc_ids[:0]
+    # кандидаты по первому символу, остальные символы сверяются только в них
+    pos = np.flatnonzero(buf[:size] == codes[0])
+    for shift, code in enumerate(codes[1:], 1):
+        pos = pos[buf[pos + shift] == code]
+    return doc_ids[pos]
+
+
+def _extract_chunk(lowered: list[str]):
+    import numpy as np
+
+    n = len(lowered)
+    lengths = np.fromiter(map(len, lowered), dtype=np.int64, count=n)
+    # документы разделены "\x00": ни одно ключевое слово его не содержит,
+    # поэтому совпадение не может пересечь границу документа
+    buf = np.frombuffer("\x00".join(lowered).encode("utf-32-le"), dtype=np.uint32)
+    doc_ids = np.repeat(np.arange(n), lengths + 1)[:len(buf)]
+
+    def count_char(c: str):
+        return np.bincount(doc_ids[buf == ord(c)], minlength=n)
+
+    def contains(pattern: str):
+        found = np.zeros(n, dtype=bool)
+        found[_substring_docs(buf, doc_ids, pattern)] = True
+        return found
+
+    quotes = count_char("'")
+    double_quotes = count_char('"')
+    semicolons = count_char(";")
+    dashes = count_char("-")
+
+    present = {k: contains(k) for k in SQL_KEYWORDS}
+    num_keywords = np.sum([present[k] for k in SQL_KEYWORDS], axis=0)
+
+    # регулярные выражения — только там, где без них не обойтись
+    num_comments = np.zeros(n, dtype=np.int64)
+    for i in np.flatnonzero(present["--"] | present["/*"] | present["*/"]):
+        num_comments[i] = len(_COMMENT_RE.findall(lowered[i]))
+    has_or_true = np.zeros(n, dtype=np.int64)
+    for i in np.flatnonzero(present["or"]):
+        has_or_true[i] = bool(_OR_TRUE_RE.search(lowered[i]))
+
+    features = np.empty((n, len(FEATURE_NAMES)), dtype=np.float64)
+    features[:, 0] = lengths
+    features[:, 1] = quotes + double_quotes
+    features[:, 2] = num_comments
+    features[:, 3] = semicolons
+    features[:, 4] = contains("union select")
+    features[:, 5] = has_or_true
+    features[:, 6] = num_keywords
+    features[:, 7] = (quotes + double_quotes + semicolons + dashes) / np.maximum(lengths, 1)
+    # "pg_sleep" содержит "sleep", так что regex sleep|pg_sleep|benchmark сводится к двум проверкам
+    features[:, 8] = present["sleep"] | present["benchmark"]
+    features[:, 9] = count_char("(") - count_char(")")
+    return features
+
+
+def extract_features_batch(queries):
+    """extract_features для всей коллекции сразу: массив (n, 10) в порядке FEATURE_NAMES."""
+    import numpy as np
+
+    lowered = [str(q).lower() for q in queries]
+    if not lowered:
+        return np.empty((0, len(FEATURE_NAMES)), dtype=np.float64)
+    return np.vstack([
+        _extract_chunk(lowered[start:start + _BATCH_CHUNK])
+        for start in range(0, len(lowered), _BATCH_CHUNK)
+    ])
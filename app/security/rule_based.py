@@ -1,5 +1,7 @@
 import re
 
+from app.security.rule_engine import RuleSet, KeywordMatcher
+
 DANGEROUS_PATTERNS = [
     r";\s*--",
     r"/\*.*?\*/",
@@ -52,11 +54,18 @@ SAFE_PATTERNS = [
     r"^\s*explain\s+(analyze\s+)?\s*select\s+",
 ]
 
+DANGEROUS_RULES = RuleSet(DANGEROUS_PATTERNS, re.IGNORECASE)
+FORBIDDEN_MATCHER = KeywordMatcher(FORBIDDEN_KEYWORDS, re.IGNORECASE)
+
+_LINE_COMMENT_RE = re.compile(r"--.*?$", re.MULTILINE)
+_BLOCK_COMMENT_RE = re.compile(r"/\*.*?\*/", re.DOTALL)
+_WHITESPACE_RE = re.compile(r'\s+')
+
 def normalize_sql(sql: str) -> str:
-    sql = re.sub(r"--.*?$", "", sql, flags=re.MULTILINE)
-    sql = re.sub(r"/\*.*?\*/", "", sql, flags=re.DOTALL)
+    sql = _LINE_COMMENT_RE.sub("", sql)
+    sql = _BLOCK_COMMENT_RE.sub("", sql)
     
-    sql = re.sub(r'\s+', ' ', sql)
+    sql = _WHITESPACE_RE.sub(' ', sql)
     
     return sql.strip()
 
@@ -76,22 +85,21 @@ def rule_based_check(sql: str) -> tuple[bool, str]:
     if not starts_with_safe:
         return True, "Non-SELECT statement is forbidden"
 
-    for kw in FORBIDDEN_KEYWORDS:
-        pattern = rf'(^|\s|;)\b{re.escape(kw)}\b(\s|\(|;|$)'
-        if re.search(pattern, s, re.IGNORECASE):
-            if not any(ctx in s for ctx in ["information_schema", "pg_catalog"]):
-                kw_pos = s.find(kw)
-                if kw_pos > 0:
-                    before = s[:kw_pos].rstrip()
-                    if before.count("'") % 2 == 1 or before.count('"') % 2 == 1:
-                        continue
-                return True, f"Forbidden keyword used as command: {kw}"
+    # упоминание системных каталогов снимает запрет на ключевые слова
+    if not any(ctx in s for ctx in ["information_schema", "pg_catalog"]):
+        found = FORBIDDEN_MATCHER.find_all(s)
+        for kw in FORBIDDEN_KEYWORDS:
+            if kw not in found:
+                continue
+            kw_pos = s.find(kw)
+            if kw_pos > 0:
+                before = s[:kw_pos].rstrip()
+                if before.count("'") % 2 == 1 or before.count('"') % 2 == 1:
+                    continue
+            return True, f"Forbidden keyword used as command: {kw}"
     
-    for pattern in DANGEROUS_PATTERNS:
-        if re.search(pattern, s, re.IGNORECASE):
-            return True, f"Matched dangerous pattern: {pattern}"
-
-    if s.startswith("select"):
-        pass
+    pattern = DANGEROUS_RULES.first_match(s)
+    if pattern is not None:
+        return True, f"Matched dangerous pattern: {pattern}"
     
     return False, ""
@@ -0,0 +1,42 @@
+import re
+
+
+class RuleSet:
+    """Набор регулярных выражений, скомпилированный один раз в общую альтернацию.
+
+    Чистый запрос проверяется одним проходом по строке. Отдельные выражения
+    перебираются по порядку только после срабатывания, чтобы назвать то же правило,
+    что и последовательная проверка списка.
+    """
+
+    def __init__(self, patterns: list[str], flags: int = 0, anchored: bool = False):
+        self.patterns = list(patterns)
+        self._rules = [re.compile(p, flags) for p in self.patterns]
+        combined = re.compile("|".join(f"(?:{p})" for p in self.patterns), flags)
+        self._anchored = anchored
+        self._find = combined.match if anchored else combined.search
+
+    def matches(self, text: str) -> bool:
+        return self._find(text) is not None
+
+    def first_match(self, text: str) -> str | None:
+        if self._find(text) is None:
+            return None
+        for pattern, rule in zip(self.patterns, self._rules):
+            found = rule.match(text) if self._anchored else rule.search(text)
+            if found:
+                return pattern
+        return None
+
+
+class KeywordMatcher:
+    """Поиск ключевых слов, стоящих отдельной командой: в начале строки или после
+    пробела/`;`, и перед пробелом, `(`, `;` или концом строки."""
+
+    def __init__(self, keywords, flags: int = 0):
+        self.keywords = list(keywords)
+        alternatives = "|".join(f"(?P<{kw}>{re.escape(kw)})" for kw in self.keywords)
+        self._regex = re.compile(rf"(?<![^\s;])(?:{alternatives})(?=\s|\(|;|$)", flags)
+
+    def find_all(self, text: str) -> set[str]:
+        return {m.lastgroup for m in self._regex.finditer(text)}
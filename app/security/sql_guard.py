@@ -1,6 +1,12 @@
+import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from app.security.rule_based import rule_based_check, normalize_sql
 from app.security.ml_guard import MLSQLGuard
+from app.security.rule_engine import RuleSet
+from app.security.guard_metrics import guard_metrics
 
 SAFE_QUERY_WHITELIST = [
     # Простые SELECT запросы
@@ -17,34 +23,27 @@ SAFE_QUERY_WHITELIST = [
     r"^\s*explain\s+(analyze\s+)?\s*select\s+.*?\s*;?\s*$",
 ]
 
+SAFE_QUERY_RULES = RuleSet(SAFE_QUERY_WHITELIST, re.IGNORECASE | re.DOTALL, anchored=True)
+
+_LINE_COMMENT_RE = re.compile(r'--.*?$', re.MULTILINE)
+_BLOCK_COMMENT_RE = re.compile(r'/\*.*?\*/', re.DOTALL)
+_DANGEROUS_IN_COMMENT_RE = re.compile(
+    r'\b(drop|delete|truncate|alter|create|insert|update|exec|execute|union|or\s+1\s*=\s*1)\b',
+    re.IGNORECASE
+)
+
 def is_whitelisted(sql: str) -> bool:
-    single_line_comments = re.findall(r'--.*?$', sql, re.MULTILINE)
-    for comment in single_line_comments:
-        dangerous_in_comment = re.search(
-            r'\b(drop|delete|truncate|alter|create|insert|update|exec|execute|union|or\s+1\s*=\s*1)\b', 
-            comment, 
-            re.IGNORECASE
-        )
-        if dangerous_in_comment:
+    for comment in _LINE_COMMENT_RE.findall(sql):
+        if _DANGEROUS_IN_COMMENT_RE.search(comment):
             return False
 
-    multi_line_comments = re.findall(r'/\*.*?\*/', sql, re.DOTALL)
-    for comment in multi_line_comments:
-        dangerous_in_comment = re.search(
-            r'\b(drop|delete|truncate|alter|create|insert|update|exec|execute|union|or\s+1\s*=\s*1)\b', 
-            comment, 
-            re.IGNORECASE
-        )
-        if dangerous_in_comment:
+    for comment in _BLOCK_COMMENT_RE.findall(sql):
+        if _DANGEROUS_IN_COMMENT_RE.search(comment):
             return False
 
     normalized = normalize_sql(sql).lower()
 
-    for pattern in SAFE_QUERY_WHITELIST:
-        if re.match(pattern, normalized, re.IGNORECASE | re.DOTALL):
-            return True
-    
-    return False
+    return SAFE_QUERY_RULES.matches(normalized)
 
 def validate_sql_structure(sql: str) -> tuple[bool, str]:
     normalized = normalize_sql(sql)
@@ -63,10 +62,124 @@ def validate_sql_structure(sql: str) -> tuple[bool, str]:
     
     return True, ""
 
+class VerdictCache:
+    """LRU-кэш вердиктов validate_sql.
+
+    Ключ — текст запроса без изменений: комментарии, кавычки и пробелы влияют
+    на структурную проверку и ML-слой, поэтому нормализованный ключ мог бы
+    вернуть чужой вердикт.
+    """
+
+    def __init__(self, max_entries: int = 4096, max_sql_length: int = 10000):
+        self.max_entries = max_entries
+        self.max_sql_length = max_sql_length
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sql: str) -> dict | None:
+        with self._lock:
+            verdict = self._entries.get(sql)
+            if verdict is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(sql)
+            self.hits += 1
+            return dict(verdict)
+
+    def put(self, sql: str, verdict: dict) -> None:
+        if self.max_entries <= 0 or len(sql) > self.max_sql_length:
+            return
+        with self._lock:
+            self._entries[sql] = dict(verdict)
+            self._entries.move_to_end(sql)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+verdict_cache = VerdictCache(int(os.environ.get("SQL_GUARD_CACHE_SIZE", "4096")))
+
+# Шаблоны запросов доверенных мест приложения: проверяются один раз при регистрации
+_templates: dict[str, dict] = {}
+_templates_lock = threading.Lock()
+
+
+def register_sql_template(name: str, sql: str) -> dict:
+    verdict = _validate_sql_uncached(sql)
+    with _templates_lock:
+        _templates[name] = {"sql": sql, "verdict": verdict}
+    return dict(verdict)
+
+
+def check_sql_template(name: str, sql: str | None = None) -> dict:
+    """Вердикт зарегистрированного шаблона. Если передан sql, а шаблона с таким именем
+    нет или его текст изменился (например, после DDL), шаблон проверяется и регистрируется."""
+    with _templates_lock:
+        entry = _templates.get(name)
+    if entry is None or (sql is not None and entry["sql"] != sql):
+        if sql is None:
+            raise KeyError(f"SQL template is not registered: {name}")
+        return register_sql_template(name, sql)
+    return dict(entry["verdict"])
+
+
+def registered_templates() -> dict[str, dict]:
+    with _templates_lock:
+        return {name: dict(entry["verdict"]) for name, entry in _templates.items()}
+
+
 def validate_sql(sql: str) -> dict:
-    if is_whitelisted(sql):
+    started = time.perf_counter()
+    verdict = verdict_cache.get(sql)
+    if verdict is not None:
+        guard_metrics.record(sql, verdict, {}, time.perf_counter() - started, cached=True)
+        return verdict
+    timings: dict[str, float] = {}
+    verdict = _validate_sql_uncached(sql, timings)
+    verdict_cache.put(sql, verdict)
+    guard_metrics.record(sql, verdict, timings, time.perf_counter() - started)
+    return dict(verdict)
+
+
+def _validate_sql_uncached(sql: str, timings: dict[str, float] | None = None) -> dict:
+    timings = {} if timings is None else timings
+    verdict = _rule_layers_verdict(sql, timings)
+    if verdict is not None:
+        return verdict
+    started = time.perf_counter()
+    malicious, score = MLSQLGuard.instance().check(sql)
+    timings["ml"] = time.perf_counter() - started
+    return _ml_verdict(malicious, score)
+
+
+def _rule_layers_verdict(sql: str, timings: dict[str, float]) -> dict | None:
+    """Вердикт слоёв до ML или None, если решать должна модель.
+    Время каждого пройденного слоя записывается в timings."""
+    started = time.perf_counter()
+    whitelisted = is_whitelisted(sql)
+    timings["whitelist"] = time.perf_counter() - started
+    if whitelisted:
         return {"allowed": True, "layer": "whitelist"}
+
+    started = time.perf_counter()
     struct_valid, struct_reason = validate_sql_structure(sql)
+    timings["structure_validation"] = time.perf_counter() - started
     if not struct_valid:
         return {
             "allowed": False,
@@ -74,15 +187,19 @@ def validate_sql(sql: str) -> dict:
             "reason": struct_reason
         }
 
+    started = time.perf_counter()
     blocked, reason = rule_based_check(sql)
+    timings["rule_based"] = time.perf_counter() - started
     if blocked:
         return {
             "allowed": False,
             "layer": "rule_based",
             "reason": reason
         }
-    guard = MLSQLGuard.instance()
-    malicious, score = guard.check(sql)
+    return None
+
+
+def _ml_verdict(malicious: bool, score: float) -> dict:
     if malicious:
         return {
             "allowed": False,
@@ -90,3 +207,38 @@ def validate_sql(sql: str) -> dict:
             "risk_score": round(score, 4)
         }
     return {"allowed": True}
+
+
+def validate_sql_batch(sqls: list[str]) -> list[dict]:
+    """То же, что validate_sql для каждого запроса, но ML-слой оценивает все
+    оставшиеся запросы одним вызовом модели."""
+    decided: dict[str, dict] = {}
+    pending: dict[str, dict[str, float]] = {}
+    for sql in dict.fromkeys(sqls):
+        started = time.perf_counter()
+        verdict = verdict_cache.get(sql)
+        if verdict is not None:
+            guard_metrics.record(sql, verdict, {}, time.perf_counter() - started, cached=True)
+        else:
+            timings: dict[str, float] = {}
+            verdict = _rule_layers_verdict(sql, timings)
+            if verdict is None:
+                pending[sql] = timings
+                continue
+            verdict_cache.put(sql, verdict)
+            guard_metrics.record(sql, verdict, timings, time.perf_counter() - started)
+        decided[sql] = verdict
+
+    if pending:
+        started = time.perf_counter()
+        scores = MLSQLGuard.instance().check_many(list(pending))
+        elapsed = time.perf_counter() - started
+        guard_metrics.observe_layer("ml_batch", elapsed)
+        # время пакета делится поровну между его запросами
+        share = elapsed / len(pending)
+        for (sql, timings), (malicious, score) in zip(pending.items(), scores):
+            decided[sql] = _ml_verdict(malicious, score)
+            verdict_cache.put(sql, decided[sql])
+            guard_metrics.record(sql, decided[sql], {**timings, "ml": share}, sum(timings.values()) + share)
+
+    return [dict(decided[sql]) for sql in sqls]
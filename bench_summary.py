@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Регрессионный бенчмарк сводки по ресторанам (get_summary).
+
+Генерирует заказы и партии в транзакции, сверяет суммы с эталоном и сравнивает
+время с прежним запросом (общий LEFT JOIN заказов и партий). В конце транзакция
+откатывается, база остаётся без изменений.
+
+    python bench_summary.py                 # 200 заказов и 50 партий на ресторан, 3 шага удвоения
+    python bench_summary.py 1000 200 4      # заказов, партий на ресторан, шагов
+"""
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.db.pool import get_pool
+from web_app import build_summary_query
+
+# прежняя реализация: заказы x партии на каждый ресторан
+FANOUT_SQL = """
+    SELECT
+      r.id AS restaurant_id,
+      COUNT(DISTINCT o.id) AS orders_count,
+      COALESCE(SUM(o.total_amount), 0) AS orders_sum,
+      COUNT(DISTINCT s.id) AS stocks_count,
+      COALESCE(SUM(s.qty), 0) AS stocks_qty
+    FROM restaurants r
+    LEFT JOIN orders o ON o.restaurant_id = r.id
+    LEFT JOIN ingredient_batches s ON s.restaurant_id = r.id
+    GROUP BY r.id
+    ORDER BY r.id
+"""
+
+EXPECTED_SQL = """
+    SELECT
+      r.id AS restaurant_id,
+      (SELECT COUNT(*) FROM orders WHERE restaurant_id = r.id) AS orders_count,
+      (SELECT COALESCE(SUM(total_amount), 0) FROM orders WHERE restaurant_id = r.id) AS orders_sum,
+      (SELECT COUNT(*) FROM ingredient_batches WHERE restaurant_id = r.id) AS stocks_count,
+      (SELECT COALESCE(SUM(qty), 0) FROM ingredient_batches WHERE restaurant_id = r.id) AS stocks_qty
+    FROM restaurants r
+    ORDER BY r.id
+"""
+
+
+def generate(cur, orders_per_rest: int, batches_per_rest: int) -> None:
+    cur.execute(
+        """
+        INSERT INTO orders (restaurant_id, order_time, status, total_amount)
+        SELECT r.id, now() - (g %% 365) * INTERVAL '1 day', 'completed', (g %% 97) * 10 + 0.5
+        FROM restaurants r, generate_series(1, %s) g
+        """,
+        (orders_per_rest,),
+    )
+    cur.execute(
+        """
+        INSERT INTO ingredient_batches (ingredient_id, restaurant_id, qty, expiry_date)
+        SELECT (SELECT MIN(id) FROM ingredients), r.id, (g %% 13) + 0.25, now()::date + g %% 30
+        FROM restaurants r, generate_series(1, %s) g
+        """,
+        (batches_per_rest,),
+    )
+
+
+def timed(cur, sql: str, params: list | None = None) -> tuple[list[tuple], float]:
+    started = time.perf_counter()
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    return rows, time.perf_counter() - started
+
+
+def main():
+    orders_per_rest = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    batches_per_rest = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    steps = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    pool = get_pool()
+    conn = pool.getconn()
+    failed = False
+    try:
+        with conn.cursor() as cur:
+            summary_sql, summary_params = build_summary_query("admin", None)
+            print(f"{'заказов':>10} {'партий':>10} {'сводка, мс':>12} {'JOIN, мс':>12}  результат")
+            loaded = 0
+            for step in range(steps):
+                # на каждом шаге объём данных удваивается
+                scale = 2 ** step
+                generate(cur, orders_per_rest * (scale - loaded), batches_per_rest * (scale - loaded))
+                loaded = scale
+                cur.execute("SELECT fn_refresh_report_rollups()")
+                cur.execute("SELECT COUNT(*), (SELECT COUNT(*) FROM ingredient_batches) FROM orders")
+                orders_total, batches_total = cur.fetchone()
+
+                expected, _ = timed(cur, EXPECTED_SQL)
+                summary, summary_time = timed(cur, summary_sql, summary_params)
+                fanout, fanout_time = timed(cur, FANOUT_SQL)
+
+                got = [(row[0], *row[2:]) for row in summary]
+                ok = got == expected
+                failed = failed or not ok
+                fanout_note = "" if fanout == expected else ", старый JOIN завышает суммы"
+                print(
+                    f"{orders_total:>10} {batches_total:>10} {summary_time * 1000:>12.1f} {fanout_time * 1000:>12.1f}"
+                    f"  {'OK' if ok else 'РАСХОЖДЕНИЕ'}{fanout_note}"
+                )
+    finally:
+        conn.rollback()
+        pool.putconn(conn)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,23 @@
+import argparse
+import logging
 import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
-from prophet import Prophet
+from psycopg2.extras import execute_values
+from sqlalchemy import create_engine, text
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import StandardScaler
 import matplotlib.pyplot as plt
 
+try:
+    from prophet import Prophet
+except ImportError:
+    # без Prophet все ряды прогнозируются сглаживанием
+    Prophet = None
+
 DB_CONFIG = {
     "dbname": "restaurant_management",
     "user": "restaurant_admin",
@@ -14,61 +26,130 @@ DB_CONFIG = {
     "port": 5432
 }
 
-# Создаём папку для результатов
-os.makedirs("ml_results", exist_ok=True)
-
 DATABASE_URL = (
     f"postgresql://{DB_CONFIG['user']}:{DB_CONFIG['password']}"
     f"@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['dbname']}"
 )
 
-engine = create_engine(DATABASE_URL)
+HORIZON_DAYS = 14
+HISTORY_DAYS = 365
+# Prophet только для рядов не короче 8 недель, остальные — сглаживание
+PROPHET_MIN_DAYS = 56
+SEASON = 7
+SMOOTHING_ALPHA = 0.3
 
+# продажи по дням из агрегатов отчётов, а не по сырым заказам
 sql_demand = """
 SELECT
-    date_trunc('day', o.order_time AT TIME ZONE 'UTC')::DATE AS day,
-    d.name AS dish,
-    SUM(oi.qty) AS qty
-FROM orders o
-JOIN order_items oi ON oi.order_id = o.id
-JOIN dishes d ON d.id = oi.dish_id
-WHERE o.status IN ('completed', 'served')
-GROUP BY day, d.name
-ORDER BY day;
+    restaurant_id,
+    dish_id,
+    day,
+    SUM(qty)::float AS qty
+FROM report_dish_daily
+WHERE status IN ('completed', 'served') AND day BETWEEN :start AND :until
+GROUP BY restaurant_id, dish_id, day
+ORDER BY restaurant_id, dish_id, day;
 """
 
-df = pd.read_sql(sql_demand, engine)
-
-print("Всего строк для ML:", len(df))
-
-if df.empty:
-    print("Нет данных для прогноза спроса")
-else:
-    # Выбираем блюдо с максимальными продажами
-    dish = df.groupby('dish')['qty'].sum().idxmax()
-    ts = df[df['dish'] == dish][['day', 'qty']].copy()
-    ts.columns = ['ds', 'y']
-    ts = ts.sort_values('ds').reset_index(drop=True)
 
-    if len(ts) < 2:
-        print(f"Недостаточно данных для Prophet по блюду '{dish}'")
+def load_series(engine, until: date, history_days: int = HISTORY_DAYS) -> list[tuple]:
+    """Ряды продаж (ресторан, блюдо, первый день, продажи по дням до until включительно).
+    Ряд начинается с первой продажи в окне, дни без продаж заполняются нулями."""
+    with engine.begin() as conn:
+        conn.execute(text("SELECT fn_refresh_report_rollups()"))
+    df = pd.read_sql(
+        text(sql_demand), engine,
+        params={"start": until - timedelta(days=history_days - 1), "until": until},
+    )
+    series = []
+    for (restaurant_id, dish_id), group in df.groupby(['restaurant_id', 'dish_id'], sort=False):
+        first_day = group['day'].iloc[0]
+        y = np.zeros((until - first_day).days + 1)
+        y[[(day - first_day).days for day in group['day']]] = group['qty'].to_numpy()
+        series.append((int(restaurant_id), int(dish_id), first_day, y))
+    return series
+
+
+def forecast_smoothing(y: np.ndarray, horizon: int) -> np.ndarray:
+    """Простое экспоненциальное сглаживание с аддитивной недельной сезонностью.
+    Сезонные поправки считаются по последним (до 8) полным неделям, для рядов
+    короче двух недель сезонность не учитывается."""
+    n = len(y)
+    weeks = min(n // SEASON, 8)
+    if weeks >= 2:
+        recent = y[n - weeks * SEASON:].reshape(weeks, SEASON)
+        season = recent.mean(axis=0) - recent.mean()
     else:
-        model = Prophet()
-        model.fit(ts)
-
-        future = model.make_future_dataframe(periods=7, freq='D')
-        forecast = model.predict(future)
-
-        # Сохраняем график
-        fig = model.plot(forecast)
-        plt.title(f"Прогноз спроса: {dish}")
-        plt.tight_layout()
-        plt.savefig(f"ml_results/prophet_{dish}.png")
-        plt.close()
+        season = np.zeros(SEASON)
+    # столбец j сезонных поправок соответствует дням t, для которых (t - n) % 7 == j
+    deseasonalized = y - season[(np.arange(n) - n) % SEASON]
+    decay = (1 - SMOOTHING_ALPHA) ** np.arange(n - 1, -1, -1)
+    weights = SMOOTHING_ALPHA * decay
+    weights[0] = decay[0]
+    level = float(weights @ deseasonalized)
+    return np.clip(level + season[np.arange(horizon) % SEASON], 0, None)
+
+
+def forecast_prophet(first_day: date, y: np.ndarray, horizon: int) -> np.ndarray:
+    logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+    history = pd.DataFrame({"ds": pd.date_range(first_day, periods=len(y), freq='D'), "y": y})
+    model = Prophet(daily_seasonality=False, yearly_seasonality=len(y) >= 2 * 365)
+    model.fit(history)
+    future = model.make_future_dataframe(periods=horizon, freq='D', include_history=False)
+    return np.clip(model.predict(future)['yhat'].to_numpy(), 0, None)
+
+
+def uses_prophet(y: np.ndarray) -> bool:
+    return Prophet is not None and len(y) >= PROPHET_MIN_DAYS
+
+
+def forecast_series(task: tuple) -> tuple[int, int, str, np.ndarray]:
+    restaurant_id, dish_id, first_day, y, horizon = task
+    if uses_prophet(y):
+        try:
+            return restaurant_id, dish_id, "prophet", forecast_prophet(first_day, y, horizon)
+        except Exception:
+            pass
+    return restaurant_id, dish_id, "smoothing", forecast_smoothing(y, horizon)
+
+
+def forecast_all(series: list[tuple], horizon: int = HORIZON_DAYS, workers: int | None = None) -> list[tuple]:
+    """Прогнозирует все ряды. В пул процессов уходят только ряды для Prophet:
+    сглаживание на NumPy быстрее передачи ряда в другой процесс."""
+    tasks = [(restaurant_id, dish_id, first_day, y, horizon) for restaurant_id, dish_id, first_day, y in series]
+    heavy = [task for task in tasks if uses_prophet(task[3])]
+    results = [forecast_series(task) for task in tasks if not uses_prophet(task[3])]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(heavy) < 2:
+        results += [forecast_series(task) for task in heavy]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(heavy))) as pool:
+            results += pool.map(forecast_series, heavy, chunksize=max(1, len(heavy) // (workers * 4)))
+    return results
+
+
+def save_forecasts(engine, results: list[tuple], first_day: date) -> int:
+    """Заменяет содержимое demand_forecasts одним пакетом в одной транзакции."""
+    rows = [
+        (restaurant_id, dish_id, first_day + timedelta(days=step), round(float(qty), 3), model)
+        for restaurant_id, dish_id, model, yhat in results
+        for step, qty in enumerate(yhat)
+    ]
+    raw = engine.raw_connection()
+    try:
+        with raw.cursor() as cur:
+            cur.execute("DELETE FROM demand_forecasts")
+            execute_values(
+                cur,
+                "INSERT INTO demand_forecasts (restaurant_id, dish_id, day, qty, model) VALUES %s",
+                rows,
+                page_size=1000,
+            )
+        raw.commit()
+    finally:
+        raw.close()
+    return len(rows)
 
-        # Выводим прогноз
-        print(f"\nПрогноз спроса на '{dish}' на следующие 7 дней:")
-        print(forecast[['ds', 'yhat']].tail(7).to_string(index=False))
 
 sql_cluster = """
 SELECT
@@ -85,13 +166,15 @@ GROUP BY d.name, d.category  -- ← ИСПРАВЛЕНО: добавлен d.cat
 HAVING SUM(oi.qty) > 0;
 """
 
-dfc = pd.read_sql(sql_cluster, engine)
-dfc = pd.get_dummies(dfc, columns=['category'])  # One-Hot Encoding
-X = dfc.select_dtypes(include=['number']).drop(columns=['avg_price', 'total_qty', 'revenue'], errors='ignore')
 
-if len(dfc) < 3:
-    print("Недостаточно данных для кластеризации")
-else:
+def cluster_dishes(engine):
+    dfc = pd.read_sql(sql_cluster, engine)
+    dfc = pd.get_dummies(dfc, columns=['category'])  # One-Hot Encoding
+
+    if len(dfc) < 3:
+        print("Недостаточно данных для кластеризации")
+        return
+
     X = dfc[['avg_price', 'total_qty', 'revenue']]
     X_scaled = StandardScaler().fit_transform(X)
 
@@ -113,5 +196,39 @@ else:
     plt.savefig("ml_results/clusters.png")
     plt.close()
 
-engine.dispose()  # Закрываем пул соединений
-print("Все результаты сохранены в папку 'ml_results'")
\ No newline at end of file
+
+def main():
+    parser = argparse.ArgumentParser(description="Прогноз спроса по блюдам всех ресторанов и кластеризация блюд")
+    parser.add_argument("--until", type=date.fromisoformat, default=None,
+                        help="последний день истории (YYYY-MM-DD), по умолчанию вчера по UTC")
+    parser.add_argument("--horizon", type=int, default=HORIZON_DAYS, help="на сколько дней прогноз")
+    parser.add_argument("--history", type=int, default=HISTORY_DAYS, help="сколько дней истории брать")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="число процессов прогноза")
+    parser.add_argument("--no-clusters", action="store_true", help="только прогноз, без кластеризации")
+    args = parser.parse_args()
+
+    until = args.until or datetime.now(timezone.utc).date() - timedelta(days=1)
+    # Создаём папку для результатов
+    os.makedirs("ml_results", exist_ok=True)
+    engine = create_engine(DATABASE_URL)
+    try:
+        series = load_series(engine, until, args.history)
+        print("Рядов для прогноза:", len(series))
+        if not series:
+            print("Нет данных для прогноза спроса")
+        else:
+            results = forecast_all(series, args.horizon, args.workers)
+            saved = save_forecasts(engine, results, until + timedelta(days=1))
+            by_model = pd.Series([model for _, _, model, _ in results]).value_counts().to_dict()
+            print(f"Прогноз на {args.horizon} дн. с {until + timedelta(days=1)} записан в demand_forecasts: "
+                  f"{saved} строк, модели {by_model}")
+
+        if not args.no_clusters:
+            cluster_dishes(engine)
+    finally:
+        engine.dispose()  # Закрываем пул соединений
+    print("Все результаты сохранены в папку 'ml_results' и таблицу demand_forecasts")
+
+
+if __name__ == '__main__':
+    main()
@@ -139,6 +139,14 @@ CREATE TABLE ingredient_batches (
     min_threshold NUMERIC(12,4) DEFAULT 0
 );
 
+-- остаток ингредиента в ресторане по активным партиям; ведётся триггерами ingredient_batches
+CREATE TABLE ingredient_stock (
+    restaurant_id INT NOT NULL REFERENCES restaurants(id) ON DELETE CASCADE,
+    ingredient_id INT NOT NULL REFERENCES ingredients(id) ON DELETE CASCADE,
+    on_hand NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (restaurant_id, ingredient_id)
+);
+
 -- Движение на складе
 CREATE TABLE inventory_movements (
     id SERIAL PRIMARY KEY,
@@ -220,44 +228,227 @@ CREATE TABLE order_items (
     special_requests TEXT
 );
 
+-- Агрегаты для отчётов: заказы по ресторану/дню/статусу и проданные блюда по дню/статусу.
+-- Дни с изменёнными заказами попадают в report_dirty_days и пересчитываются fn_refresh_report_rollups
+CREATE TABLE report_orders_daily (
+    restaurant_id INT NOT NULL,
+    day DATE NOT NULL,
+    status TEXT NOT NULL,
+    orders_count BIGINT NOT NULL,
+    total_amount NUMERIC,
+    PRIMARY KEY (restaurant_id, day, status)
+);
+
+CREATE TABLE report_dish_daily (
+    restaurant_id INT NOT NULL,
+    day DATE NOT NULL,
+    status TEXT NOT NULL,
+    dish_id INT NOT NULL,
+    qty BIGINT NOT NULL,
+    revenue NUMERIC NOT NULL DEFAULT 0,
+    PRIMARY KEY (restaurant_id, day, status, dish_id)
+);
+
+-- очередь дней на пересчёт: только вставки, чтобы параллельные заказы не блокировали друг друга
+CREATE TABLE report_dirty_days (
+    restaurant_id INT NOT NULL,
+    day DATE NOT NULL
+);
+
+CREATE TABLE report_refresh_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    refreshed_at TIMESTAMP WITH TIME ZONE
+);
+INSERT INTO report_refresh_state (id, refreshed_at) VALUES (TRUE, NULL);
+
+-- водяной знак данных ресторана: когда пересчёт последний раз затронул его дни (ключ кэша графиков)
+CREATE TABLE report_restaurant_watermarks (
+    restaurant_id INT PRIMARY KEY,
+    changed_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+-- Загрузка ресторана для ETA: число активных заказов и среднее время готовки блюд.
+-- Ведётся триггерами orders и dishes, чтобы ETA не пересчитывал их при каждом вызове
+CREATE TABLE restaurant_load (
+    restaurant_id INT PRIMARY KEY REFERENCES restaurants(id) ON DELETE CASCADE,
+    active_orders INT NOT NULL DEFAULT 0,
+    avg_prep_minutes INT NOT NULL DEFAULT 20
+);
+
+-- Прогноз спроса по блюдам каждого ресторана на ближайшие дни: пересчитывается
+-- ночным запуском clastering.py целиком (model — prophet или smoothing)
+CREATE TABLE demand_forecasts (
+    restaurant_id INT NOT NULL REFERENCES restaurants(id) ON DELETE CASCADE,
+    dish_id INT NOT NULL REFERENCES dishes(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    qty NUMERIC(12,3) NOT NULL,
+    model TEXT NOT NULL,
+    generated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+    PRIMARY KEY (restaurant_id, dish_id, day)
+);
+
+-- Сегменты блюд по продажам (ml.py: MiniBatchKMeans, дообучается при каждом запуске)
+CREATE TABLE dish_segments (
+    dish_id INT PRIMARY KEY REFERENCES dishes(id) ON DELETE CASCADE,
+    cluster INT NOT NULL,
+    segment TEXT NOT NULL,
+    total_qty BIGINT NOT NULL,
+    total_revenue NUMERIC NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+-- ETA = (текущие заказы - лимит + 1) * среднее время готовки; NULL — можно сейчас
+CREATE OR REPLACE FUNCTION fn_eta_minutes(p_active_orders INT, p_max_orders INT, p_avg_prep_minutes INT)
+RETURNS INT LANGUAGE sql IMMUTABLE AS $$
+    SELECT CASE
+        WHEN p_active_orders < p_max_orders THEN NULL
+        ELSE (p_active_orders - p_max_orders + 1) * p_avg_prep_minutes
+    END;
+$$;
+
 CREATE OR REPLACE FUNCTION fn_get_eta_for_restaurant(p_restaurant_id INT)
-RETURNS INT LANGUAGE plpgsql AS $$
-DECLARE
-    v_current INT;
-    v_max INT;
-    v_avg_prep_time INT;
+RETURNS INT LANGUAGE sql STABLE AS $$
+    SELECT fn_eta_minutes(
+        COALESCE(l.active_orders, 0),
+        r.max_concurrent_orders,
+        COALESCE(l.avg_prep_minutes, 20)
+    )
+    FROM restaurants r
+    LEFT JOIN restaurant_load l ON l.restaurant_id = r.id
+    WHERE r.id = p_restaurant_id;
+$$;
+
+-- Возвращает рестораны в том же городе с доступным ETA (ETA считается один раз на ресторан)
+CREATE OR REPLACE FUNCTION fn_suggest_alternative_restaurants(p_restaurant_id INT)
+RETURNS TABLE (id INT, name TEXT, eta_minutes INT) LANGUAGE sql STABLE AS $$
+    SELECT r.id, r.name, e.eta_minutes
+    FROM restaurants cur
+    JOIN restaurants r ON r.city_id = cur.city_id AND r.id <> cur.id
+    LEFT JOIN restaurant_load l ON l.restaurant_id = r.id
+    CROSS JOIN LATERAL (
+        SELECT fn_eta_minutes(
+            COALESCE(l.active_orders, 0),
+            r.max_concurrent_orders,
+            COALESCE(l.avg_prep_minutes, 20)
+        ) AS eta_minutes
+    ) e
+    WHERE cur.id = p_restaurant_id
+      AND (e.eta_minutes IS NULL OR e.eta_minutes < 60)
+    ORDER BY e.eta_minutes NULLS FIRST
+    LIMIT 3;
+$$;
+
+-- Переносит в restaurant_load изменение числа активных заказов за оператор
+CREATE OR REPLACE FUNCTION trg_orders_restaurant_load()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
 BEGIN
-    SELECT COUNT(*) INTO v_current
-    FROM orders
-    WHERE restaurant_id = p_restaurant_id
-      AND status IN ('created', 'confirmed', 'preparing');
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO restaurant_load AS l (restaurant_id, active_orders)
+        SELECT restaurant_id, COUNT(*) FROM new_rows
+        WHERE status IN ('created', 'confirmed', 'preparing')
+        GROUP BY restaurant_id
+        ON CONFLICT (restaurant_id) DO UPDATE SET active_orders = l.active_orders + EXCLUDED.active_orders;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE restaurant_load l SET active_orders = l.active_orders - d.cnt
+        FROM (
+            SELECT restaurant_id, COUNT(*) AS cnt FROM old_rows
+            WHERE status IN ('created', 'confirmed', 'preparing')
+            GROUP BY restaurant_id
+        ) d
+        WHERE l.restaurant_id = d.restaurant_id;
+    ELSE
+        INSERT INTO restaurant_load AS l (restaurant_id, active_orders)
+        SELECT restaurant_id, SUM(delta) FROM (
+            SELECT restaurant_id, 1 AS delta FROM new_rows
+            WHERE status IN ('created', 'confirmed', 'preparing')
+            UNION ALL
+            SELECT restaurant_id, -1 FROM old_rows
+            WHERE status IN ('created', 'confirmed', 'preparing')
+        ) c
+        GROUP BY restaurant_id
+        HAVING SUM(delta) <> 0
+        ON CONFLICT (restaurant_id) DO UPDATE SET active_orders = l.active_orders + EXCLUDED.active_orders;
+    END IF;
+    RETURN NULL;
+END;
+$$;
 
-    SELECT max_concurrent_orders INTO v_max FROM restaurants WHERE id = p_restaurant_id;
-    SELECT COALESCE(AVG(prep_time_minutes), 20) INTO v_avg_prep_time
-    FROM dishes WHERE restaurant_id = p_restaurant_id;
+CREATE TRIGGER trg_orders_restaurant_load_insert
+AFTER INSERT ON orders
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_orders_restaurant_load();
+
+CREATE TRIGGER trg_orders_restaurant_load_update
+AFTER UPDATE ON orders
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_orders_restaurant_load();
+
+CREATE TRIGGER trg_orders_restaurant_load_delete
+AFTER DELETE ON orders
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_orders_restaurant_load();
+
+-- Пересчитывает среднее время готовки ресторанов, у которых изменилось меню
+CREATE OR REPLACE FUNCTION fn_refresh_restaurant_prep_time(p_restaurant_ids INT[])
+RETURNS VOID LANGUAGE sql AS $$
+    INSERT INTO restaurant_load AS l (restaurant_id, avg_prep_minutes)
+    SELECT r.id, COALESCE((SELECT AVG(prep_time_minutes) FROM dishes WHERE restaurant_id = r.id), 20)::int
+    FROM restaurants r
+    WHERE r.id = ANY(p_restaurant_ids)
+    ON CONFLICT (restaurant_id) DO UPDATE SET avg_prep_minutes = EXCLUDED.avg_prep_minutes;
+$$;
 
-    IF v_current < v_max THEN
-        RETURN NULL; -- можно сейчас
+CREATE OR REPLACE FUNCTION trg_dishes_restaurant_load()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM fn_refresh_restaurant_prep_time(ARRAY(SELECT DISTINCT restaurant_id FROM new_rows));
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM fn_refresh_restaurant_prep_time(ARRAY(SELECT DISTINCT restaurant_id FROM old_rows));
     ELSE
-        -- ETA = (текущие заказы - лимит + 1) * среднее время готовки
-        RETURN (v_current - v_max + 1) * v_avg_prep_time;
+        PERFORM fn_refresh_restaurant_prep_time(ARRAY(
+            SELECT n.restaurant_id FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE (n.restaurant_id, n.prep_time_minutes) IS DISTINCT FROM (o.restaurant_id, o.prep_time_minutes)
+            UNION
+            SELECT o.restaurant_id FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE (n.restaurant_id, n.prep_time_minutes) IS DISTINCT FROM (o.restaurant_id, o.prep_time_minutes)
+        ));
     END IF;
+    RETURN NULL;
 END;
 $$;
 
--- Возвращает рестораны в том же городе с доступным ETA
-CREATE OR REPLACE FUNCTION fn_suggest_alternative_restaurants(p_restaurant_id INT)
-RETURNS TABLE (id INT, name TEXT, eta_minutes INT) LANGUAGE sql AS $$
-    WITH current_city AS (
-        SELECT city_id FROM restaurants WHERE id = p_restaurant_id
-    )
-    SELECT r.id, r.name, fn_get_eta_for_restaurant(r.id) AS eta_minutes
-    FROM restaurants r, current_city c
-    WHERE r.city_id = c.city_id
-      AND r.id <> p_restaurant_id
-      AND (fn_get_eta_for_restaurant(r.id) IS NULL OR fn_get_eta_for_restaurant(r.id) < 60)
-    ORDER BY eta_minutes NULLS FIRST
-    LIMIT 3;
+CREATE TRIGGER trg_dishes_restaurant_load_insert
+AFTER INSERT ON dishes
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_dishes_restaurant_load();
+
+CREATE TRIGGER trg_dishes_restaurant_load_update
+AFTER UPDATE ON dishes
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_dishes_restaurant_load();
+
+CREATE TRIGGER trg_dishes_restaurant_load_delete
+AFTER DELETE ON dishes
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_dishes_restaurant_load();
+
+-- Пересобирает restaurant_load по заказам и меню (для уже заполненной базы)
+CREATE OR REPLACE FUNCTION fn_rebuild_restaurant_load()
+RETURNS VOID LANGUAGE sql AS $$
+    DELETE FROM restaurant_load;
+    INSERT INTO restaurant_load (restaurant_id, active_orders, avg_prep_minutes)
+    SELECT r.id,
+           (SELECT COUNT(*) FROM orders o
+            WHERE o.restaurant_id = r.id AND o.status IN ('created', 'confirmed', 'preparing')),
+           COALESCE((SELECT AVG(prep_time_minutes) FROM dishes WHERE restaurant_id = r.id), 20)::int
+    FROM restaurants r;
 $$;
 
 -- Обновляет completed_by_user при финализации заказа
@@ -276,7 +467,7 @@ BEFORE UPDATE ON orders
 FOR EACH ROW
 EXECUTE FUNCTION fn_set_completed_by_user();
 
--- пересчитывает сумму заказа
+-- пересчитывает сумму заказа целиком (триггер позиций ведёт её по разнице; функция — для исправления)
 CREATE OR REPLACE FUNCTION fn_recalc_order_total(p_order_id INT)
 RETURNS VOID LANGUAGE sql AS $$
     UPDATE orders
@@ -288,28 +479,36 @@ RETURNS VOID LANGUAGE sql AS $$
     WHERE id = p_order_id;
 $$;
 
--- Обновляет is_available у блюд
+-- Обновляет is_available у блюд ресторана одним UPDATE; если передан список
+-- ингредиентов — только у блюд, в рецепт которых они входят
+CREATE OR REPLACE FUNCTION fn_update_dishes_availability(p_restaurant_id INT, p_ingredient_ids INT[] DEFAULT NULL)
+RETURNS VOID LANGUAGE sql AS $$
+    UPDATE dishes d
+    SET is_available = a.is_available
+    FROM (
+        SELECT d2.id,
+               NOT EXISTS (
+                   SELECT 1 FROM dish_ingredients di
+                   LEFT JOIN ingredient_stock st
+                          ON st.restaurant_id = d2.restaurant_id
+                         AND st.ingredient_id = di.ingredient_id
+                   WHERE di.dish_id = d2.id
+                     AND COALESCE(st.on_hand, 0) < di.qty_required
+               ) AS is_available
+        FROM dishes d2
+        WHERE d2.restaurant_id = p_restaurant_id
+          AND (p_ingredient_ids IS NULL OR EXISTS (
+              SELECT 1 FROM dish_ingredients di
+              WHERE di.dish_id = d2.id AND di.ingredient_id = ANY(p_ingredient_ids)
+          ))
+    ) a
+    WHERE d.id = a.id AND d.is_available IS DISTINCT FROM a.is_available;
+$$;
+
+-- Обновляет is_available у всех блюд ресторана
 CREATE OR REPLACE FUNCTION fn_update_dishes_availability_for_restaurant(p_restaurant_id INT)
-RETURNS VOID LANGUAGE plpgsql AS $$
-DECLARE
-    rec_dish RECORD;
-    missing_count INT;
-BEGIN
-    FOR rec_dish IN SELECT * FROM dishes WHERE restaurant_id = p_restaurant_id
-    LOOP
-        SELECT COUNT(*) INTO missing_count
-        FROM dish_ingredients di
-        LEFT JOIN (
-            SELECT ingredient_id, SUM(qty) AS total_qty
-            FROM ingredient_batches
-            WHERE restaurant_id = p_restaurant_id AND active = TRUE
-            GROUP BY ingredient_id
-        ) ib ON di.ingredient_id = ib.ingredient_id
-        WHERE di.dish_id = rec_dish.id AND COALESCE(ib.total_qty,0) < di.qty_required;
-
-        UPDATE dishes SET is_available = (missing_count = 0) WHERE id = rec_dish.id;
-    END LOOP;
-END;
+RETURNS VOID LANGUAGE sql AS $$
+    SELECT fn_update_dishes_availability(p_restaurant_id);
 $$;
 
 --  оценки и комментарии к заказам.
@@ -345,97 +544,239 @@ CREATE TABLE reservations (
 -- Вспомогательная: суммарный остаток ингредиента в ресторане (по активным партиям)
 CREATE OR REPLACE FUNCTION fn_total_ingredient_qty(p_ingredient_id INT, p_restaurant_id INT)
 RETURNS NUMERIC LANGUAGE sql AS $$
-    SELECT COALESCE(SUM(qty),0) FROM ingredient_batches
-    WHERE ingredient_id = p_ingredient_id AND restaurant_id = p_restaurant_id AND active = TRUE;
+    SELECT COALESCE((
+        SELECT on_hand FROM ingredient_stock
+        WHERE ingredient_id = p_ingredient_id AND restaurant_id = p_restaurant_id
+    ), 0);
+$$;
+
+-- Переносит изменения активных партий в ingredient_stock одним запросом на оператор
+-- и обновляет доступность только блюд с изменившимися ингредиентами
+CREATE OR REPLACE FUNCTION trg_ingredient_batches_stock()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+DECLARE
+    v_restaurant_ids INT[];
+    v_ingredient_ids INT[];
+    v_deltas NUMERIC[];
+    v_restaurant_id INT;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(restaurant_id), array_agg(ingredient_id), array_agg(delta)
+        INTO v_restaurant_ids, v_ingredient_ids, v_deltas
+        FROM (
+            SELECT restaurant_id, ingredient_id, SUM(qty) AS delta
+            FROM new_rows WHERE active = TRUE
+            GROUP BY restaurant_id, ingredient_id
+            HAVING SUM(qty) <> 0
+        ) d;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(restaurant_id), array_agg(ingredient_id), array_agg(delta)
+        INTO v_restaurant_ids, v_ingredient_ids, v_deltas
+        FROM (
+            SELECT restaurant_id, ingredient_id, -SUM(qty) AS delta
+            FROM old_rows WHERE active = TRUE
+            GROUP BY restaurant_id, ingredient_id
+            HAVING SUM(qty) <> 0
+        ) d;
+    ELSE
+        SELECT array_agg(restaurant_id), array_agg(ingredient_id), array_agg(delta)
+        INTO v_restaurant_ids, v_ingredient_ids, v_deltas
+        FROM (
+            SELECT restaurant_id, ingredient_id, SUM(qty) AS delta
+            FROM (
+                SELECT restaurant_id, ingredient_id, qty FROM new_rows WHERE active = TRUE
+                UNION ALL
+                SELECT restaurant_id, ingredient_id, -qty FROM old_rows WHERE active = TRUE
+            ) c
+            GROUP BY restaurant_id, ingredient_id
+            HAVING SUM(qty) <> 0
+        ) d;
+    END IF;
+
+    IF v_restaurant_ids IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO ingredient_stock AS st (restaurant_id, ingredient_id, on_hand)
+    SELECT * FROM unnest(v_restaurant_ids, v_ingredient_ids, v_deltas)
+    ON CONFLICT (restaurant_id, ingredient_id) DO UPDATE SET on_hand = st.on_hand + EXCLUDED.on_hand;
+
+    FOR v_restaurant_id IN SELECT DISTINCT unnest(v_restaurant_ids)
+    LOOP
+        PERFORM fn_update_dishes_availability(v_restaurant_id, ARRAY(
+            SELECT c.ingredient_id
+            FROM unnest(v_restaurant_ids, v_ingredient_ids) AS c(restaurant_id, ingredient_id)
+            WHERE c.restaurant_id = v_restaurant_id
+        ));
+    END LOOP;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER trg_ingredient_batches_stock_insert
+AFTER INSERT ON ingredient_batches
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_ingredient_batches_stock();
+
+CREATE TRIGGER trg_ingredient_batches_stock_update
+AFTER UPDATE ON ingredient_batches
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_ingredient_batches_stock();
+
+CREATE TRIGGER trg_ingredient_batches_stock_delete
+AFTER DELETE ON ingredient_batches
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_ingredient_batches_stock();
+
+-- Пересобирает ingredient_stock по партиям (для уже заполненной базы или после ручных правок)
+CREATE OR REPLACE FUNCTION fn_rebuild_ingredient_stock()
+RETURNS VOID LANGUAGE plpgsql AS $$
+BEGIN
+    DELETE FROM ingredient_stock;
+    INSERT INTO ingredient_stock (restaurant_id, ingredient_id, on_hand)
+    SELECT restaurant_id, ingredient_id, SUM(qty)
+    FROM ingredient_batches
+    WHERE active = TRUE
+    GROUP BY restaurant_id, ingredient_id;
+    PERFORM fn_update_dishes_availability_for_restaurant(r.id) FROM restaurants r;
+END;
 $$;
 
--- Списывает ингредиенты при финализации заказа (использует min_threshold из партий)
+-- Изменение рецепта сразу пересчитывает доступность блюда (старого и нового при смене dish_id)
+CREATE OR REPLACE FUNCTION trg_dish_ingredients_availability()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE dishes d
+    SET is_available = NOT EXISTS (
+        SELECT 1 FROM dish_ingredients di
+        LEFT JOIN ingredient_stock st
+               ON st.restaurant_id = d.restaurant_id
+              AND st.ingredient_id = di.ingredient_id
+        WHERE di.dish_id = d.id
+          AND COALESCE(st.on_hand, 0) < di.qty_required
+    )
+    -- при переносе строки рецепта на другое блюдо пересчитываются оба блюда
+    WHERE d.id IN (NEW.dish_id, OLD.dish_id);
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER trg_dish_ingredients_after_change
+AFTER INSERT OR UPDATE OR DELETE ON dish_ingredients
+FOR EACH ROW
+EXECUTE FUNCTION trg_dish_ingredients_availability();
+
+-- Списывает ингредиенты при финализации заказа (использует min_threshold из партий).
+-- Потребность заказа считается одним агрегатом и распределяется по партиям FIFO
+-- оконной суммой; партии, движения и заявки обновляются пакетно.
 CREATE OR REPLACE FUNCTION fn_decrease_stock_for_order(p_order_id INT)
 RETURNS VOID LANGUAGE plpgsql AS $$
 DECLARE
-    rec_item RECORD;
-    rec_recipe RECORD;
-    v_needed NUMERIC;
-    v_batch RECORD;
-    v_left NUMERIC;
-    v_total_left NUMERIC;
-    v_min_threshold NUMERIC;
     v_restaurant_id INT;
+    v_ingredient_ids INT[];
+    v_needed NUMERIC[];
+    v_short RECORD;
 BEGIN
-    -- Получаем restaurant_id один раз
     SELECT restaurant_id INTO v_restaurant_id FROM orders WHERE id = p_order_id;
 
-    -- Для всех позиций заказа
-    FOR rec_item IN SELECT * FROM order_items WHERE order_id = p_order_id
-    LOOP
-        -- Для всех ингредиентов блюда
-        FOR rec_recipe IN SELECT * FROM dish_ingredients WHERE dish_id = rec_item.dish_id
-        LOOP
-            v_needed := rec_recipe.qty_required * rec_item.qty;
-
-            LOOP
-                IF v_needed <= 0 THEN
-                    EXIT;
-                END IF;
-
-                SELECT * INTO v_batch FROM ingredient_batches
-                WHERE ingredient_id = rec_recipe.ingredient_id
-                  AND restaurant_id = v_restaurant_id
-                  AND active = TRUE
-                  AND qty > 0
-                ORDER BY COALESCE(expiry_date, 'infinity') ASC
-                FOR UPDATE
-                LIMIT 1;
-
-                IF NOT FOUND THEN
-                    RAISE EXCEPTION 'Не хватает ингридиента % для ресторана % нужно %',
-                        rec_recipe.ingredient_id, v_restaurant_id, v_needed;
-                END IF;
-
-                IF v_batch.qty >= v_needed THEN
-                    UPDATE ingredient_batches SET qty = qty - v_needed WHERE id = v_batch.id;
-                    INSERT INTO inventory_movements (batch_id, ingredient_id, restaurant_id, change_qty, reason, related_order_id)
-                    VALUES (v_batch.id, rec_recipe.ingredient_id, v_restaurant_id, -v_needed, 'order', p_order_id);
-                    v_needed := 0;
-                ELSE
-                    v_left := v_batch.qty;
-                    UPDATE ingredient_batches SET qty = 0, active = FALSE WHERE id = v_batch.id;
-                    INSERT INTO inventory_movements (batch_id, ingredient_id, restaurant_id, change_qty, reason, related_order_id)
-                    VALUES (v_batch.id, rec_recipe.ingredient_id, v_restaurant_id, -v_left, 'order', p_order_id);
-                    v_needed := v_needed - v_left;
-                END IF;
-            END LOOP;
-
-            -- Получаем минимальный порог для этого ингредиента в ресторане
-            SELECT COALESCE(MIN(min_threshold), 5) INTO v_min_threshold
-            FROM ingredient_batches
-            WHERE ingredient_id = rec_recipe.ingredient_id
-              AND restaurant_id = v_restaurant_id;
-
-            -- Проверяем общий остаток по ингредиенту
-            SELECT COALESCE(SUM(qty), 0) INTO v_total_left
-            FROM ingredient_batches
-            WHERE ingredient_id = rec_recipe.ingredient_id
-              AND restaurant_id = v_restaurant_id
-              AND active = TRUE;
-
-            -- Если остаток <= порога — создаём заявку
-            IF v_total_left <= v_min_threshold THEN
-                IF NOT EXISTS (
-                    SELECT 1 FROM purchase_requests
-                    WHERE restaurant_id = v_restaurant_id
-                      AND ingredient_id = rec_recipe.ingredient_id
-                      AND status IN ('new','ordered')
-                ) THEN
-                    INSERT INTO purchase_requests (restaurant_id, ingredient_id, qty, status)
-                    VALUES (v_restaurant_id, rec_recipe.ingredient_id, v_min_threshold * 10, 'new');
-                END IF;
-            END IF;
-        END LOOP;
-    END LOOP;
+    -- Потребность по ингредиентам для всех позиций заказа
+    SELECT array_agg(ingredient_id ORDER BY ingredient_id), array_agg(needed ORDER BY ingredient_id)
+    INTO v_ingredient_ids, v_needed
+    FROM (
+        SELECT di.ingredient_id, SUM(di.qty_required * oi.qty) AS needed
+        FROM order_items oi
+        JOIN dish_ingredients di ON di.dish_id = oi.dish_id
+        WHERE oi.order_id = p_order_id
+        GROUP BY di.ingredient_id
+    ) demand;
+
+    IF v_ingredient_ids IS NULL THEN
+        RETURN;
+    END IF;
+
+    -- Блокируем партии в порядке id, чтобы параллельные списания не взаимоблокировались
+    PERFORM 1 FROM ingredient_batches
+    WHERE restaurant_id = v_restaurant_id
+      AND ingredient_id = ANY(v_ingredient_ids)
+      AND active = TRUE
+      AND qty > 0
+    ORDER BY id
+    FOR UPDATE;
+
+    SELECT d.ingredient_id, d.needed - COALESCE(SUM(b.qty), 0) AS missing INTO v_short
+    FROM unnest(v_ingredient_ids, v_needed) AS d(ingredient_id, needed)
+    LEFT JOIN ingredient_batches b
+           ON b.ingredient_id = d.ingredient_id
+          AND b.restaurant_id = v_restaurant_id
+          AND b.active = TRUE
+          AND b.qty > 0
+    GROUP BY d.ingredient_id, d.needed
+    HAVING COALESCE(SUM(b.qty), 0) < d.needed
+    ORDER BY d.ingredient_id
+    LIMIT 1;
+
+    IF FOUND THEN
+        RAISE EXCEPTION 'Не хватает ингридиента % для ресторана % нужно %',
+            v_short.ingredient_id, v_restaurant_id, v_short.missing;
+    END IF;
 
-    -- Обновляем доступность блюд
-    PERFORM fn_update_dishes_availability_for_restaurant(v_restaurant_id);
+    -- FIFO: партия берётся, пока сумма предыдущих партий меньше потребности;
+    -- исчерпанная партия (остаток меньше оставшейся потребности) деактивируется
+    WITH fifo AS (
+        SELECT b.id, b.ingredient_id, b.qty, d.needed,
+               SUM(b.qty) OVER (
+                   PARTITION BY b.ingredient_id
+                   ORDER BY COALESCE(b.expiry_date, 'infinity'), b.id
+               ) AS running_qty
+        FROM unnest(v_ingredient_ids, v_needed) AS d(ingredient_id, needed)
+        JOIN ingredient_batches b
+          ON b.ingredient_id = d.ingredient_id
+         AND b.restaurant_id = v_restaurant_id
+         AND b.active = TRUE
+         AND b.qty > 0
+    ), taken AS (
+        SELECT id, ingredient_id,
+               LEAST(qty, needed - (running_qty - qty)) AS take_qty,
+               running_qty < needed AS exhausted
+        FROM fifo
+        WHERE running_qty - qty < needed
+    ), updated AS (
+        UPDATE ingredient_batches b
+        SET qty = CASE WHEN t.exhausted THEN 0 ELSE b.qty - t.take_qty END,
+            active = NOT t.exhausted
+        FROM taken t
+        WHERE b.id = t.id
+    )
+    INSERT INTO inventory_movements (batch_id, ingredient_id, restaurant_id, change_qty, reason, related_order_id)
+    SELECT id, ingredient_id, v_restaurant_id, -take_qty, 'order', p_order_id
+    FROM taken;
+
+    -- Если остаток <= порога — создаём заявку (не больше одной открытой на ингредиент)
+    INSERT INTO purchase_requests (restaurant_id, ingredient_id, qty, status)
+    SELECT v_restaurant_id, s.ingredient_id, s.min_threshold * 10, 'new'
+    FROM (
+        SELECT i.ingredient_id,
+               COALESCE(MIN(b.min_threshold), 5) AS min_threshold,
+               COALESCE(SUM(b.qty) FILTER (WHERE b.active = TRUE), 0) AS total_qty
+        FROM unnest(v_ingredient_ids) AS i(ingredient_id)
+        LEFT JOIN ingredient_batches b
+               ON b.ingredient_id = i.ingredient_id
+              AND b.restaurant_id = v_restaurant_id
+        GROUP BY i.ingredient_id
+    ) s
+    WHERE s.total_qty <= s.min_threshold
+      AND NOT EXISTS (
+          SELECT 1 FROM purchase_requests pr
+          WHERE pr.restaurant_id = v_restaurant_id
+            AND pr.ingredient_id = s.ingredient_id
+            AND pr.status IN ('new', 'ordered')
+      )
+    ON CONFLICT (restaurant_id, ingredient_id) WHERE status IN ('new', 'ordered') DO NOTHING;
+
+    -- Доступность блюд с затронутыми ингредиентами обновляет триггер ingredient_batches
 END;
 $$;
 
@@ -459,13 +800,11 @@ END;
 $$;
 
 -- Функция, которая помечает просроченные партии и обновляет доступность блюд
--- Отмечает просроченные партии и обновляет доступность
+-- Отмечает просроченные партии; доступность затронутых блюд обновляет триггер ingredient_batches
 CREATE OR REPLACE FUNCTION fn_mark_expired_batches_and_update()
 RETURNS VOID LANGUAGE plpgsql AS $$
 BEGIN
     UPDATE ingredient_batches SET active = FALSE WHERE expiry_date IS NOT NULL AND expiry_date < now()::date AND active = TRUE;
-    -- Обновить доступность для всех ресторанов
-    PERFORM fn_update_dishes_availability_for_restaurant(r.id) FROM restaurants r;
 END;
 $$;
 
@@ -481,22 +820,237 @@ RETURNS TABLE (dish_id INT, name TEXT, similarity_score FLOAT) LANGUAGE sql AS $
     LIMIT p_limit;
 $$;
 
--- триггер для пересчёта суммы заказа при изменении позиций
+-- триггер для пересчёта суммы заказа при изменении позиций: к сумме прибавляется разница
+-- qty * price_at_order по позициям оператора, по одному UPDATE заказа на оператор
 CREATE OR REPLACE FUNCTION trg_order_items_recalc_total()
 RETURNS TRIGGER LANGUAGE plpgsql AS $$
+DECLARE
+    v_order_ids INT[];
+    v_items INT[];
+    v_deltas NUMERIC[];
 BEGIN
-    PERFORM fn_recalc_order_total(
-        COALESCE(NEW.order_id, OLD.order_id)
-    );
+    IF TG_OP = 'INSERT' THEN
+        SELECT array_agg(order_id), array_agg(items), array_agg(delta)
+        INTO v_order_ids, v_items, v_deltas
+        FROM (
+            SELECT order_id, COUNT(*) AS items, SUM(qty * price_at_order) AS delta
+            FROM new_rows
+            GROUP BY order_id
+        ) d;
+    ELSIF TG_OP = 'DELETE' THEN
+        SELECT array_agg(order_id), array_agg(items), array_agg(delta)
+        INTO v_order_ids, v_items, v_deltas
+        FROM (
+            SELECT order_id, -COUNT(*) AS items, -SUM(qty * price_at_order) AS delta
+            FROM old_rows
+            GROUP BY order_id
+        ) d;
+    ELSE
+        SELECT array_agg(order_id), array_agg(items), array_agg(delta)
+        INTO v_order_ids, v_items, v_deltas
+        FROM (
+            SELECT order_id, SUM(items) AS items, SUM(amount) AS delta
+            FROM (
+                SELECT order_id, 1 AS items, qty * price_at_order AS amount FROM new_rows
+                UNION ALL
+                SELECT order_id, -1, -qty * price_at_order FROM old_rows
+            ) c
+            GROUP BY order_id
+            HAVING SUM(amount) <> 0 OR SUM(items) <> 0
+        ) d;
+    END IF;
+
+    IF v_order_ids IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    -- первые позиции заказа заменяют сумму, введённую вручную при создании
+    UPDATE orders o
+    SET total_amount = CASE
+        WHEN d.items > 0 AND (SELECT COUNT(*) FROM order_items oi WHERE oi.order_id = o.id) = d.items
+            THEN d.delta
+        ELSE COALESCE(o.total_amount, 0) + d.delta
+    END
+    FROM unnest(v_order_ids, v_items, v_deltas) AS d(order_id, items, delta)
+    WHERE o.id = d.order_id AND (d.delta <> 0 OR d.items > 0);
     RETURN NULL;
 END;
 $$;
 
-CREATE TRIGGER trg_order_items_after_change
-AFTER INSERT OR UPDATE OR DELETE ON order_items
-FOR EACH ROW
+CREATE TRIGGER trg_order_items_total_insert
+AFTER INSERT ON order_items
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_order_items_recalc_total();
+
+CREATE TRIGGER trg_order_items_total_update
+AFTER UPDATE ON order_items
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_order_items_recalc_total();
+
+CREATE TRIGGER trg_order_items_total_delete
+AFTER DELETE ON order_items
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT
 EXECUTE FUNCTION trg_order_items_recalc_total();
 
+-- день заказа для агрегатов отчётов (в UTC, чтобы не зависеть от TimeZone сессии)
+CREATE OR REPLACE FUNCTION fn_report_day(p_order_time TIMESTAMP WITH TIME ZONE)
+RETURNS DATE LANGUAGE sql IMMUTABLE AS $$
+    SELECT COALESCE((p_order_time AT TIME ZONE 'UTC')::date, DATE '1970-01-01');
+$$;
+
+-- Помечает дни заказов, изменённых оператором, для пересчёта агрегатов
+CREATE OR REPLACE FUNCTION trg_orders_report_dirty()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO report_dirty_days (restaurant_id, day)
+        SELECT DISTINCT restaurant_id, fn_report_day(order_time) FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO report_dirty_days (restaurant_id, day)
+        SELECT DISTINCT restaurant_id, fn_report_day(order_time) FROM old_rows;
+    ELSE
+        INSERT INTO report_dirty_days (restaurant_id, day)
+        SELECT DISTINCT c.restaurant_id, fn_report_day(c.order_time)
+        FROM new_rows n
+        JOIN old_rows o ON o.id = n.id
+        CROSS JOIN LATERAL (VALUES (n.restaurant_id, n.order_time), (o.restaurant_id, o.order_time)) AS c(restaurant_id, order_time)
+        WHERE (n.restaurant_id, n.order_time, n.status, n.total_amount)
+              IS DISTINCT FROM (o.restaurant_id, o.order_time, o.status, o.total_amount);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER trg_orders_report_dirty_insert
+AFTER INSERT ON orders
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_orders_report_dirty();
+
+CREATE TRIGGER trg_orders_report_dirty_update
+AFTER UPDATE ON orders
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_orders_report_dirty();
+
+CREATE TRIGGER trg_orders_report_dirty_delete
+AFTER DELETE ON orders
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_orders_report_dirty();
+
+-- То же для позиций: помечается день заказа, к которому относится позиция
+CREATE OR REPLACE FUNCTION trg_order_items_report_dirty()
+RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO report_dirty_days (restaurant_id, day)
+        SELECT DISTINCT o.restaurant_id, fn_report_day(o.order_time)
+        FROM new_rows i JOIN orders o ON o.id = i.order_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        INSERT INTO report_dirty_days (restaurant_id, day)
+        SELECT DISTINCT o.restaurant_id, fn_report_day(o.order_time)
+        FROM old_rows i JOIN orders o ON o.id = i.order_id;
+    ELSE
+        INSERT INTO report_dirty_days (restaurant_id, day)
+        SELECT DISTINCT o.restaurant_id, fn_report_day(o.order_time)
+        FROM new_rows n
+        JOIN old_rows p ON p.id = n.id
+        JOIN orders o ON o.id IN (n.order_id, p.order_id)
+        WHERE (n.order_id, n.dish_id, n.qty) IS DISTINCT FROM (p.order_id, p.dish_id, p.qty);
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER trg_order_items_report_dirty_insert
+AFTER INSERT ON order_items
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_order_items_report_dirty();
+
+CREATE TRIGGER trg_order_items_report_dirty_update
+AFTER UPDATE ON order_items
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_order_items_report_dirty();
+
+CREATE TRIGGER trg_order_items_report_dirty_delete
+AFTER DELETE ON order_items
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT
+EXECUTE FUNCTION trg_order_items_report_dirty();
+
+-- Пересчитывает агрегаты отчётов за помеченные дни и возвращает момент, на который они актуальны.
+-- Если прошлый пересчёт моложе p_max_age, ничего не делает; p_full пересчитывает всю историю.
+CREATE OR REPLACE FUNCTION fn_refresh_report_rollups(p_max_age INTERVAL DEFAULT '0', p_full BOOLEAN DEFAULT FALSE)
+RETURNS TIMESTAMP WITH TIME ZONE LANGUAGE plpgsql AS $$
+DECLARE
+    v_refreshed_at TIMESTAMP WITH TIME ZONE;
+    v_restaurant_ids INT[];
+    v_days DATE[];
+BEGIN
+    SELECT refreshed_at INTO v_refreshed_at FROM report_refresh_state;
+    IF NOT p_full AND v_refreshed_at IS NOT NULL AND v_refreshed_at > now() - p_max_age THEN
+        RETURN v_refreshed_at;
+    END IF;
+    -- пересчёт уже идёт в другой сессии: отдаём агрегаты как есть
+    IF NOT pg_try_advisory_xact_lock(hashtext('fn_refresh_report_rollups')) THEN
+        RETURN v_refreshed_at;
+    END IF;
+
+    IF p_full THEN
+        INSERT INTO report_dirty_days (restaurant_id, day)
+        SELECT DISTINCT restaurant_id, fn_report_day(order_time) FROM orders
+        UNION
+        SELECT restaurant_id, day FROM report_orders_daily;
+    END IF;
+
+    -- удаляются только видимые (закоммиченные) отметки; отметки незавершённых
+    -- транзакций останутся в очереди до следующего пересчёта
+    WITH taken AS (
+        DELETE FROM report_dirty_days RETURNING restaurant_id, day
+    )
+    SELECT array_agg(restaurant_id), array_agg(day)
+    INTO v_restaurant_ids, v_days
+    FROM (SELECT DISTINCT restaurant_id, day FROM taken) d;
+
+    IF v_restaurant_ids IS NOT NULL THEN
+        DELETE FROM report_orders_daily r
+        USING unnest(v_restaurant_ids, v_days) AS d(restaurant_id, day)
+        WHERE r.restaurant_id = d.restaurant_id AND r.day = d.day;
+
+        DELETE FROM report_dish_daily r
+        USING unnest(v_restaurant_ids, v_days) AS d(restaurant_id, day)
+        WHERE r.restaurant_id = d.restaurant_id AND r.day = d.day;
+
+        INSERT INTO report_orders_daily (restaurant_id, day, status, orders_count, total_amount)
+        SELECT o.restaurant_id, d.day, o.status, COUNT(*), SUM(o.total_amount)
+        FROM unnest(v_restaurant_ids, v_days) AS d(restaurant_id, day)
+        JOIN orders o ON o.restaurant_id = d.restaurant_id AND fn_report_day(o.order_time) = d.day
+        GROUP BY o.restaurant_id, d.day, o.status;
+
+        INSERT INTO report_dish_daily (restaurant_id, day, status, dish_id, qty, revenue)
+        SELECT o.restaurant_id, d.day, o.status, oi.dish_id, SUM(oi.qty), COALESCE(SUM(oi.qty * oi.price_at_order), 0)
+        FROM unnest(v_restaurant_ids, v_days) AS d(restaurant_id, day)
+        JOIN orders o ON o.restaurant_id = d.restaurant_id AND fn_report_day(o.order_time) = d.day
+        JOIN order_items oi ON oi.order_id = o.id
+        GROUP BY o.restaurant_id, d.day, o.status, oi.dish_id;
+
+        INSERT INTO report_restaurant_watermarks (restaurant_id, changed_at)
+        SELECT DISTINCT restaurant_id, now() FROM unnest(v_restaurant_ids) AS restaurant_id
+        ON CONFLICT (restaurant_id) DO UPDATE SET changed_at = EXCLUDED.changed_at;
+    END IF;
+
+    v_refreshed_at := now();
+    UPDATE report_refresh_state SET refreshed_at = v_refreshed_at;
+    RETURN v_refreshed_at;
+END;
+$$;
+
 -- сощздаем роли
 CREATE ROLE role_admin NOLOGIN;
 CREATE ROLE role_analyst NOLOGIN;
@@ -521,8 +1075,10 @@ cities, restaurants, restaurant_tables,
 employees, employee_assignments,
 dishes, dish_ingredients, dish_price_history,
 orders, order_items,
-ingredients, ingredient_batches, inventory_movements, purchase_requests,
-suppliers, reservations, feedbacks, audit_logs
+ingredients, ingredient_batches, ingredient_stock, inventory_movements, purchase_requests,
+suppliers, reservations, feedbacks, audit_logs,
+report_orders_daily, report_dish_daily, report_refresh_state, report_restaurant_watermarks, restaurant_load,
+demand_forecasts, dish_segments
 TO role_analyst;
 
 -- Manager: заказы, инвентарь, сотрудники
@@ -531,16 +1087,18 @@ orders, order_items, reservations, purchase_requests
 TO role_manager;
 
 GRANT SELECT, INSERT, UPDATE ON
-ingredient_batches, inventory_movements
+ingredient_batches, ingredient_stock, inventory_movements
 TO role_manager;
 
+GRANT SELECT ON demand_forecasts, dish_segments TO role_manager;
+
 -- Cook: смотерть заказы и ингредиенты
 GRANT SELECT ON
-orders, order_items, dishes, dish_ingredients
+orders, order_items, dishes, dish_ingredients, dish_segments
 TO role_cook;
 
 GRANT SELECT ON
-ingredients, ingredient_batches
+ingredients, ingredient_batches, ingredient_stock
 TO role_cook;
 
 GRANT INSERT ON purchase_requests TO role_cook;
@@ -550,6 +1108,10 @@ GRANT SELECT ON dishes TO role_waiter;
 GRANT SELECT, INSERT ON orders, order_items TO role_waiter;
 GRANT UPDATE (status) ON orders TO role_waiter;
 
+-- триггеры заказов пишут в очередь пересчёта отчётов
+GRANT INSERT ON report_dirty_days TO role_manager, role_waiter;
+GRANT SELECT, INSERT, UPDATE ON restaurant_load TO role_manager, role_waiter;
+
 -- orders
 ALTER TABLE orders ENABLE ROW LEVEL SECURITY;
 
@@ -734,6 +1296,114 @@ CREATE INDEX idx_orders_restaurant_status ON orders (restaurant_id, status);
 
 CREATE INDEX idx_order_items_order_id ON order_items(order_id);
 
+CREATE INDEX idx_orders_restaurant_report_day ON orders (restaurant_id, fn_report_day(order_time));
+
 CREATE INDEX idx_dish_ingredients_dish ON dish_ingredients(dish_id);
 
-CREATE INDEX idx_ingredient_batches_restaurant_ingredient_active ON ingredient_batches (restaurant_id, ingredient_id) WHERE active = TRUE;
\ No newline at end of file
+CREATE INDEX idx_dish_ingredients_ingredient ON dish_ingredients(ingredient_id, dish_id);
+
+CREATE INDEX idx_ingredient_batches_restaurant_ingredient_active ON ingredient_batches (restaurant_id, ingredient_id) WHERE active = TRUE;
+
+-- Не больше одной открытой заявки (new/ordered) на ингредиент в ресторане
+CREATE UNIQUE INDEX uq_purchase_requests_open ON purchase_requests (restaurant_id, ingredient_id)
+WHERE status IN ('new', 'ordered');
+
+-- Заявки на закупку одним INSERT ... SELECT для ресторана (или всей сети при NULL):
+-- то же правило, что в fn_decrease_stock_for_order (остаток <= порога -> заявка на порог * 10),
+-- но сразу по всем ингредиентам. Возвращает число созданных заявок.
+CREATE OR REPLACE FUNCTION fn_generate_purchase_requests(p_restaurant_id INT DEFAULT NULL)
+RETURNS INT LANGUAGE sql AS $$
+    WITH stock AS (
+        SELECT restaurant_id, ingredient_id,
+               COALESCE(MIN(min_threshold), 5) AS min_threshold,
+               COALESCE(SUM(qty) FILTER (WHERE active = TRUE), 0) AS total_qty
+        FROM ingredient_batches
+        WHERE p_restaurant_id IS NULL OR restaurant_id = p_restaurant_id
+        GROUP BY restaurant_id, ingredient_id
+    ), created AS (
+        INSERT INTO purchase_requests (restaurant_id, ingredient_id, qty, status)
+        SELECT s.restaurant_id, s.ingredient_id, s.min_threshold * 10, 'new'
+        FROM stock s
+        WHERE s.total_qty <= s.min_threshold
+          AND NOT EXISTS (
+              SELECT 1 FROM purchase_requests pr
+              WHERE pr.restaurant_id = s.restaurant_id
+                AND pr.ingredient_id = s.ingredient_id
+                AND pr.status IN ('new', 'ordered')
+          )
+        ON CONFLICT (restaurant_id, ingredient_id) WHERE status IN ('new', 'ordered') DO NOTHING
+        RETURNING 1
+    )
+    SELECT COUNT(*)::int FROM created;
+$$;
+
+-- Сколько дней, начиная с сегодняшнего (UTC), покрывает сохранённый прогноз ресторана (или сети)
+CREATE OR REPLACE FUNCTION fn_forecast_coverage_days(p_restaurant_id INT DEFAULT NULL)
+RETURNS INT LANGUAGE sql STABLE AS $$
+    SELECT GREATEST(COALESCE(MAX(day) - (now() AT TIME ZONE 'UTC')::date + 1, 0), 0)
+    FROM demand_forecasts
+    WHERE p_restaurant_id IS NULL OR restaurant_id = p_restaurant_id;
+$$;
+
+-- Заявки по прогнозу спроса на p_days дней вперёд (дни UTC, как в demand_forecasts).
+-- Прогноз продаж блюд умножается на техкарты одним соединением с группировкой
+-- (разреженное произведение «ресторан x блюдо» на «блюдо x ингредиент»). Из потребности
+-- с порогом партии как страховым запасом вычитаются активные остатки, кроме партий,
+-- истекающих внутри окна, и уже заказанное (status = 'ordered'). На нехватку создаётся
+-- заявка, открытая заявка 'new' пересчитывается до нужного объёма. Если по ингредиенту уже
+-- есть заказанная заявка, а нехватка осталась, вторую открытую заявку uq_purchase_requests_open
+-- не допускает: такие ингредиенты не оформляются и возвращаются в blocked.
+-- Окно не длиннее сохранённого прогноза (fn_forecast_coverage_days): иначе потребность
+-- считалась бы за меньший срок, чем исключаемые истекающие партии.
+CREATE OR REPLACE FUNCTION fn_plan_purchase_requests(p_restaurant_id INT DEFAULT NULL, p_days INT DEFAULT 7)
+RETURNS TABLE (created INT, updated INT, blocked INT) LANGUAGE sql AS $$
+    WITH horizon AS (
+        SELECT (now() AT TIME ZONE 'UTC')::date AS first_day,
+               LEAST(p_days, fn_forecast_coverage_days(p_restaurant_id)) AS days
+    ), demand AS (
+        SELECT f.restaurant_id, di.ingredient_id, SUM(f.qty * di.qty_required) AS need_qty
+        FROM demand_forecasts f
+        JOIN dish_ingredients di ON di.dish_id = f.dish_id
+        CROSS JOIN horizon h
+        WHERE f.day >= h.first_day
+          AND f.day < h.first_day + h.days
+          AND (p_restaurant_id IS NULL OR f.restaurant_id = p_restaurant_id)
+        GROUP BY f.restaurant_id, di.ingredient_id
+    ), stock AS (
+        SELECT b.restaurant_id, b.ingredient_id,
+               MIN(b.min_threshold) AS min_threshold,
+               COALESCE(SUM(b.qty) FILTER (
+                   WHERE b.active = TRUE
+                     AND (b.expiry_date IS NULL OR b.expiry_date >= h.first_day + h.days)
+               ), 0) AS usable_qty
+        FROM ingredient_batches b
+        CROSS JOIN horizon h
+        WHERE p_restaurant_id IS NULL OR b.restaurant_id = p_restaurant_id
+        GROUP BY b.restaurant_id, b.ingredient_id, h.first_day, h.days
+    ), ordered AS (
+        SELECT restaurant_id, ingredient_id, SUM(qty) AS ordered_qty
+        FROM purchase_requests
+        WHERE status = 'ordered' AND (p_restaurant_id IS NULL OR restaurant_id = p_restaurant_id)
+        GROUP BY restaurant_id, ingredient_id
+    ), plan AS (
+        SELECT d.restaurant_id, d.ingredient_id,
+               ROUND(d.need_qty + COALESCE(s.min_threshold, 5)
+                     - COALESCE(s.usable_qty, 0) - COALESCE(o.ordered_qty, 0), 4) AS qty,
+               o.ordered_qty IS NOT NULL AS has_ordered
+        FROM demand d
+        LEFT JOIN stock s ON s.restaurant_id = d.restaurant_id AND s.ingredient_id = d.ingredient_id
+        LEFT JOIN ordered o ON o.restaurant_id = d.restaurant_id AND o.ingredient_id = d.ingredient_id
+    ), upserted AS (
+        INSERT INTO purchase_requests (restaurant_id, ingredient_id, qty, status)
+        SELECT restaurant_id, ingredient_id, qty, 'new'
+        FROM plan
+        WHERE qty > 0 AND NOT has_ordered
+        ON CONFLICT (restaurant_id, ingredient_id) WHERE status IN ('new', 'ordered')
+        DO UPDATE SET qty = EXCLUDED.qty
+        WHERE purchase_requests.status = 'new' AND purchase_requests.qty <> EXCLUDED.qty
+        RETURNING xmax = 0 AS inserted
+    )
+    SELECT (SELECT COUNT(*) FILTER (WHERE inserted) FROM upserted)::int,
+           (SELECT COUNT(*) FILTER (WHERE NOT inserted) FROM upserted)::int,
+           (SELECT COUNT(*) FROM plan WHERE qty > 0 AND has_ordered)::int;
+$$;
@@ -1,9 +1,11 @@
+import argparse
 import os
+import joblib
 import pandas as pd
 import matplotlib.pyplot as plt
-from sqlalchemy import create_engine
-from sklearn.cluster import KMeans
-from sklearn.pipeline import Pipeline
+from psycopg2.extras import execute_values
+from sqlalchemy import create_engine, text
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.preprocessing import StandardScaler
 
 DB_CONFIG = {
@@ -16,46 +18,71 @@ DB_CONFIG = {
 
 DATABASE_URL = f"postgresql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['dbname']}"
 
-os.makedirs("ml_results", exist_ok=True)
-
-print("Загружаем данные...")
-engine = create_engine(DATABASE_URL)
+MODEL_PATH = "ml_results/dish_segments_model.joblib"
+N_CLUSTERS = 3
+FEATURES = ['total_revenue', 'total_qty']
 
+# Итоги по блюдам из агрегатов отчётов: фильтр статуса применяется к самим продажам
+# (в прежнем LEFT JOIN к orders он не отсекал позиции других статусов)
 sql = """
-SELECT 
+SELECT
+    d.id AS dish_id,
     d.name AS dish_name,
-    SUM(oi.qty) AS total_qty,
-    SUM(oi.qty * oi.price_at_order) AS total_revenue,
+    SUM(r.qty)::bigint AS total_qty,
+    SUM(r.revenue)::float AS total_revenue,
     d.price
-FROM dishes d
-LEFT JOIN order_items oi ON oi.dish_id = d.id
-LEFT JOIN orders o ON o.id = oi.order_id AND o.status IN ('completed', 'served')
+FROM report_dish_daily r
+JOIN dishes d ON d.id = r.dish_id
+WHERE r.status IN ('completed', 'served')
 GROUP BY d.id, d.name, d.price
-HAVING SUM(oi.qty) > 0
+HAVING SUM(r.qty) > 0
 ORDER BY total_revenue DESC;
       """
 
-df = pd.read_sql(sql, engine)
-engine.dispose()
-
-print(f"Блюд с продажами: {len(df)}")
 
-if len(df) >= 3:
-    print("\nКластеризация на 3 группы...")
+def load_dish_totals(engine) -> pd.DataFrame:
+    with engine.begin() as conn:
+        conn.execute(text("SELECT fn_refresh_report_rollups()"))
+    return pd.read_sql(sql, engine)
 
-    # Признаки
-    X = df[['total_revenue', 'total_qty']].values
 
+def load_model(path: str = MODEL_PATH) -> dict:
+    """Сохранённая модель или новая, если файла нет или признаки изменились."""
+    if os.path.exists(path):
+        model = joblib.load(path)
+        if model.get("features") == FEATURES and model["kmeans"].n_clusters == N_CLUSTERS:
+            return model
+    return {
+        "features": FEATURES,
+        "scaler": StandardScaler(),
+        "kmeans": MiniBatchKMeans(n_clusters=N_CLUSTERS, random_state=42, n_init=3),
+    }
 
-    pipeline = Pipeline([
-        ('scaler', StandardScaler()),
-        ('kmeans', KMeans(n_clusters=3, random_state=42)),
-    ])
 
-    df['cluster'] = pipeline.fit_predict(X)
+def update_model(model: dict, X) -> list[int]:
+    """Переобучает модель на текущих накопленных итогах и возвращает метки.
 
+    Итоги накопительные, поэтому модель не дообучается (partial_fit учитывал бы те же
+    продажи при каждом запуске заново), а обучается на них целиком: масштабирование —
+    с нуля, k-means — от центров прошлого запуска, переведённых в новый масштаб.
+    Так номера кластеров между запусками остаются прежними.
+    """
+    old_scaler, old_kmeans = model["scaler"], model["kmeans"]
+    scaler = StandardScaler().fit(X)
+    X_scaled = scaler.transform(X)
+    if hasattr(old_kmeans, "cluster_centers_") and hasattr(old_scaler, "mean_"):
+        init = scaler.transform(old_scaler.inverse_transform(old_kmeans.cluster_centers_))
+        kmeans = MiniBatchKMeans(n_clusters=N_CLUSTERS, init=init, n_init=1, random_state=42)
+    else:
+        kmeans = MiniBatchKMeans(n_clusters=N_CLUSTERS, random_state=42, n_init=3)
+    kmeans.fit(X_scaled)
+    model.update(scaler=scaler, kmeans=kmeans)
+    return kmeans.predict(X_scaled)
+
+
+def name_clusters(df: pd.DataFrame) -> dict[int, str]:
     cluster_info = {}
-    for cluster_id in range(3):
+    for cluster_id in sorted(df['cluster'].unique()):
         cluster_data = df[df['cluster'] == cluster_id]
         avg_revenue = cluster_data['total_revenue'].mean()
         avg_qty = cluster_data['total_qty'].mean()
@@ -67,9 +94,31 @@ if len(df) >= 3:
         else:
             name = "СРЕДНИЕ"
 
-        cluster_info[cluster_id] = name
-        df.loc[df['cluster'] == cluster_id, 'cluster_name'] = name
+        cluster_info[int(cluster_id)] = name
+    return cluster_info
+
+
+def save_segments(engine, df: pd.DataFrame) -> None:
+    """Заменяет содержимое dish_segments одним пакетом в одной транзакции."""
+    rows = [
+        (int(row.dish_id), int(row.cluster), row.cluster_name, int(row.total_qty), float(row.total_revenue))
+        for row in df.itertuples()
+    ]
+    raw = engine.raw_connection()
+    try:
+        with raw.cursor() as cur:
+            cur.execute("DELETE FROM dish_segments")
+            execute_values(
+                cur,
+                "INSERT INTO dish_segments (dish_id, cluster, segment, total_qty, total_revenue) VALUES %s",
+                rows,
+            )
+        raw.commit()
+    finally:
+        raw.close()
+
 
+def plot_segments(df: pd.DataFrame, cluster_info: dict[int, str]) -> None:
     # 3. Создаём график
     plt.figure(figsize=(12, 8))
 
@@ -83,7 +132,7 @@ if len(df) >= 3:
             cluster_data['total_qty'],
             cluster_data['total_revenue'],
             s=100,
-            c=colors[i],
+            c=colors[i % len(colors)],
             alpha=0.7,
             edgecolors='black',
             linewidth=1,
@@ -121,4 +170,45 @@ if len(df) >= 3:
     # Сохраняем график
     plt.tight_layout()
     plt.savefig('ml_results/clusters_plot.png', dpi=150, bbox_inches='tight')
-    print("График сохранён: ml_results/clusters_plot.png")
\ No newline at end of file
+    plt.close()
+    print("График сохранён: ml_results/clusters_plot.png")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сегментация блюд по продажам")
+    parser.add_argument("--reset", action="store_true", help="обучить модель заново, не загружая сохранённую")
+    parser.add_argument("--no-plot", action="store_true", help="не рисовать график")
+    args = parser.parse_args()
+
+    os.makedirs("ml_results", exist_ok=True)
+
+    print("Загружаем данные...")
+    engine = create_engine(DATABASE_URL)
+    try:
+        df = load_dish_totals(engine)
+        print(f"Блюд с продажами: {len(df)}")
+
+        if len(df) < N_CLUSTERS:
+            print("Недостаточно данных для кластеризации")
+            return
+
+        print(f"\nКластеризация на {N_CLUSTERS} группы...")
+        if args.reset and os.path.exists(MODEL_PATH):
+            os.remove(MODEL_PATH)
+        model = load_model()
+        df['cluster'] = update_model(model, df[FEATURES].values)
+        joblib.dump(model, MODEL_PATH)
+
+        cluster_info = name_clusters(df)
+        df['cluster_name'] = df['cluster'].map(cluster_info)
+        save_segments(engine, df)
+        print(f"Сегменты записаны в dish_segments: {len(df)} блюд, модель — {MODEL_PATH}")
+
+        if not args.no_plot:
+            plot_segments(df, cluster_info)
+    finally:
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,5 @@
 import re
-from app.security.sql_guard import validate_sql
+from app.security.sql_guard import validate_sql, validate_sql_batch
 
 def extract_sql_queries(file_path: str) -> list[tuple[str, str]]:
     queries = []
@@ -81,6 +81,13 @@ def test_queries(queries: list[tuple[str, str]]):
     print("=" * 80)
     print()
     
+    # весь корпус оценивается ML-моделью одним пакетом; при сбое — по одному запросу
+    try:
+        batch_results = validate_sql_batch([sql for _, sql in queries])
+    except Exception as e:
+        print(f"⚠️  Пакетная проверка не удалась ({e}), проверяем по одному")
+        batch_results = None
+    
     for i, (description, sql) in enumerate(queries, 1):
         if not sql.strip():
             continue
@@ -89,7 +96,7 @@ def test_queries(queries: list[tuple[str, str]]):
         print(f"SQL: {sql[:100]}{'...' if len(sql) > 100 else ''}")
         
         try:
-            result = validate_sql(sql)
+            result = batch_results[i - 1] if batch_results is not None else validate_sql(sql)
             
             if result['allowed']:
                 layer = result.get('layer', 'unknown')
@@ -1,9 +1,18 @@
+import argparse
+import hashlib
+import json
 import os
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import psycopg2
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import warnings
-warnings.filterwarnings('ignore')
+# pandas предупреждает о соединении psycopg2 без SQLAlchemy; остальные предупреждения не глушатся,
+# модуль импортируется и веб-приложением
+warnings.filterwarnings('ignore', message='pandas only supports SQLAlchemy')
 
 DB_CONFIG = {
     "dbname": "restaurant_management",
@@ -13,9 +22,11 @@ DB_CONFIG = {
     "port": 5432
 }
 
-os.makedirs("visualizations", exist_ok=True)
-
-conn = psycopg2.connect(**DB_CONFIG)
+OUTPUT_DIR = "visualizations"
+# отпечатки входных данных уже нарисованных графиков
+MANIFEST_NAME = ".chart_fingerprints.json"
+# меняется при изменении оформления, чтобы перерисовать все графики
+CHART_STYLE_VERSION = 1
 
 sql_popular_dishes = """
 SELECT
@@ -26,22 +37,11 @@ FROM order_items oi
 JOIN orders o ON o.id = oi.order_id
 JOIN dishes d ON d.id = oi.dish_id
 JOIN restaurants r ON r.id = o.restaurant_id
+{where}
 GROUP BY r.name, d.name
-ORDER BY r.name, total_qty DESC;
+ORDER BY r.name, total_qty DESC, d.name;
 """
 
-df = pd.read_sql(sql_popular_dishes, conn)
-
-for restaurant in df['restaurant'].unique():
-    subset = df[df['restaurant'] == restaurant].head(5)
-    plt.figure(figsize=(10, 6))
-    plt.bar(subset['dish'], subset['total_qty'])
-    plt.title(f"Топ-5 блюд — {restaurant}")
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-    plt.savefig(f"visualizations/top_dishes_{restaurant}.png")
-    plt.close()  # Закрываем фигуру
-
 sql_hours = """
 SELECT
     r.name AS restaurant,
@@ -49,24 +49,11 @@ SELECT
     COUNT(*) AS orders_count
 FROM orders o
 JOIN restaurants r ON r.id = o.restaurant_id
+{where}
 GROUP BY r.name, hour
 ORDER BY r.name, hour;
 """
 
-df_hours = pd.read_sql(sql_hours, conn)
-
-for restaurant in df_hours['restaurant'].unique():
-    sub = df_hours[df_hours['restaurant'] == restaurant]
-    plt.figure(figsize=(10, 6))
-    plt.plot(sub['hour'], sub['orders_count'], marker='o')
-    plt.title(f"Загруженность — {restaurant}")
-    plt.xlabel("Час")
-    plt.ylabel("Заказы")
-    plt.grid(True)
-    plt.tight_layout()
-    plt.savefig(f"visualizations/hourly_load_{restaurant}.png")
-    plt.close()
-
 sql_category = """
 SELECT
     r.name AS restaurant,
@@ -76,22 +63,11 @@ FROM order_items oi
 JOIN orders o ON o.id = oi.order_id
 JOIN dishes d ON d.id = oi.dish_id
 JOIN restaurants r ON r.id = o.restaurant_id
+{where}
 GROUP BY r.name, d.category
-ORDER BY revenue DESC;
+ORDER BY revenue DESC, r.name, d.category;
 """
 
-df_cat = pd.read_sql(sql_category, conn)
-
-for restaurant in df_cat['restaurant'].unique():
-    sub = df_cat[df_cat['restaurant'] == restaurant]
-    plt.figure(figsize=(10, 6))
-    plt.bar(sub['category'], sub['revenue'])
-    plt.title(f"Прибыль по категориям — {restaurant}")
-    plt.xticks(rotation=45, ha='right')
-    plt.tight_layout()
-    plt.savefig(f"visualizations/category_revenue_{restaurant}.png")
-    plt.close()
-
 sql_ing = """
 SELECT
     i.name,
@@ -105,16 +81,216 @@ ORDER BY total_used DESC
 LIMIT 10;
 """
 
-df_ing = pd.read_sql(sql_ing, conn)
 
-plt.figure(figsize=(12, 6))
-plt.bar(df_ing['name'], df_ing['total_used'])
-plt.title("Топ-10 используемых ингредиентов")
-plt.xticks(rotation=45, ha='right')
-plt.tight_layout()
-plt.savefig("visualizations/top_ingredients.png")
-plt.close()
+def _filters(restaurants: list[str] | None, date_from: str | None = None,
+             date_to: str | None = None) -> tuple[str, list]:
+    # ресторан задаётся id или названием; даты — дни заказа в UTC, как в агрегатах отчётов
+    conditions, params = [], []
+    if restaurants:
+        conditions.append("(r.id = ANY(%s::int[]) OR r.name = ANY(%s::text[]))")
+        params += [
+            [int(r) for r in restaurants if str(r).isdigit()],
+            [str(r) for r in restaurants if not str(r).isdigit()],
+        ]
+    if date_from:
+        conditions.append("fn_report_day(o.order_time) >= %s::date")
+        params.append(date_from)
+    if date_to:
+        conditions.append("fn_report_day(o.order_time) <= %s::date")
+        params.append(date_to)
+    return ("WHERE " + " AND ".join(conditions) if conditions else ""), params
+
+
+def _values(series) -> list:
+    return [v if isinstance(v, str) else float(v) for v in series]
+
+
+def _spec(filename: str, kind: str, title: str, x, y, **options) -> dict:
+    return {
+        "filename": filename,
+        "kind": kind,
+        "title": title,
+        "x": _values(x),
+        "y": _values(y),
+        **options,
+    }
+
+
+def _top_dishes_specs(df) -> list[dict]:
+    specs = []
+    for restaurant in df['restaurant'].unique():
+        subset = df[df['restaurant'] == restaurant].head(5)
+        specs.append(_spec(
+            f"top_dishes_{restaurant}.png", "bar", f"Топ-5 блюд — {restaurant}",
+            subset['dish'], subset['total_qty'], rotate_labels=True,
+        ))
+    return specs
+
+
+def _hourly_load_specs(df) -> list[dict]:
+    specs = []
+    for restaurant in df['restaurant'].unique():
+        sub = df[df['restaurant'] == restaurant]
+        specs.append(_spec(
+            f"hourly_load_{restaurant}.png", "line", f"Загруженность — {restaurant}",
+            sub['hour'], sub['orders_count'], xlabel="Час", ylabel="Заказы", grid=True,
+        ))
+    return specs
+
+
+def _category_revenue_specs(df) -> list[dict]:
+    specs = []
+    for restaurant in df['restaurant'].unique():
+        sub = df[df['restaurant'] == restaurant]
+        specs.append(_spec(
+            f"category_revenue_{restaurant}.png", "bar", f"Прибыль по категориям — {restaurant}",
+            sub['category'].fillna("—"), sub['revenue'], rotate_labels=True,
+        ))
+    return specs
+
+
+# графики по ресторанам: тип -> (запрос, построение описаний)
+RESTAURANT_CHARTS = {
+    "top_dishes": (sql_popular_dishes, _top_dishes_specs),
+    "hourly_load": (sql_hours, _hourly_load_specs),
+    "category_revenue": (sql_category, _category_revenue_specs),
+}
+
+
+def load_chart_specs(conn, restaurants: list[str] | None = None, date_from: str | None = None,
+                     date_to: str | None = None, charts: list[str] | None = None) -> list[dict]:
+    """Выполняет запросы и возвращает описания графиков: только данные, без рисования."""
+    where, params = _filters(restaurants, date_from, date_to)
+    specs = []
+    for name, (sql, build) in RESTAURANT_CHARTS.items():
+        if charts is None or name in charts:
+            specs += build(pd.read_sql(sql.format(where=where), conn, params=params or None))
+    # графики за период пишутся в свои файлы и не затирают графики за всю историю;
+    # фильтр по ресторанам имени не меняет: график ресторана от него не зависит
+    # (порядок в запросах полный, чтобы равные значения не переставлялись между запусками)
+    if date_from or date_to:
+        for spec in specs:
+            stem = spec["filename"][:-len(".png")]
+            spec["filename"] = f"{stem}_{date_from or 'min'}_{date_to or 'max'}.png"
+
+    # общий график сети строится только без фильтров, иначе он перезаписался бы частичными данными
+    if charts is None and not (restaurants or date_from or date_to):
+        df_ing = pd.read_sql(sql_ing, conn)
+        specs.append(_spec(
+            "top_ingredients.png", "bar", "Топ-10 используемых ингредиентов",
+            df_ing['name'], df_ing['total_used'], rotate_labels=True, figsize=[12, 6],
+        ))
+    return specs
+
+
+def chart_fingerprint(spec: dict) -> str:
+    payload = json.dumps({"style": CHART_STYLE_VERSION, **spec}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def render_chart_png(spec: dict) -> bytes:
+    """Рисует график через объектный API Agg: без pyplot и глобального состояния,
+    поэтому безопасно в пуле процессов и в потоках веб-приложения."""
+    fig = Figure(figsize=tuple(spec.get("figsize", (10, 6))))
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    if spec["kind"] == "line":
+        ax.plot(spec["x"], spec["y"], marker='o')
+    else:
+        ax.bar(spec["x"], spec["y"])
+    ax.set_title(spec["title"])
+    if spec.get("xlabel"):
+        ax.set_xlabel(spec["xlabel"])
+    if spec.get("ylabel"):
+        ax.set_ylabel(spec["ylabel"])
+    if spec.get("grid"):
+        ax.grid(True)
+    if spec.get("rotate_labels"):
+        ax.tick_params(axis='x', labelrotation=45)
+        for label in ax.get_xticklabels():
+            label.set_horizontalalignment('right')
+    fig.tight_layout()
+    buf = BytesIO()
+    canvas.print_png(buf)
+    return buf.getvalue()
+
+
+def render_chart(spec: dict, output_dir: str) -> str:
+    path = os.path.join(output_dir, spec["filename"])
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(render_chart_png(spec))
+    os.replace(tmp_path, path)
+    return spec["filename"]
+
+
+def _load_manifest(output_dir: str) -> dict:
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(output_dir: str, manifest: dict) -> None:
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
+def render_charts(specs: list[dict], output_dir: str = OUTPUT_DIR, workers: int | None = None,
+                  force: bool = False) -> tuple[list[str], list[str]]:
+    """Рисует графики с изменившимися данными в пуле процессов.
+    Возвращает (перерисованные, пропущенные) имена файлов."""
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = _load_manifest(output_dir)
+    pending, skipped = [], []
+    for spec in specs:
+        fingerprint = chart_fingerprint(spec)
+        path = os.path.join(output_dir, spec["filename"])
+        if not force and manifest.get(spec["filename"]) == fingerprint and os.path.exists(path):
+            skipped.append(spec["filename"])
+        else:
+            pending.append((spec, fingerprint))
+
+    rendered = []
+    if pending:
+        workers = workers or os.cpu_count() or 1
+        if workers > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as pool:
+                futures = [(pool.submit(render_chart, spec, output_dir), spec, fp) for spec, fp in pending]
+                for future, spec, fingerprint in futures:
+                    rendered.append(future.result())
+                    manifest[spec["filename"]] = fingerprint
+        else:
+            for spec, fingerprint in pending:
+                rendered.append(render_chart(spec, output_dir))
+                manifest[spec["filename"]] = fingerprint
+        _save_manifest(output_dir, manifest)
+    return rendered, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Графики по заказам ресторанов")
+    parser.add_argument("-r", "--restaurant", action="append",
+                        help="id или название ресторана (можно несколько раз); по умолчанию все")
+    parser.add_argument("--from", dest="date_from", help="с даты заказа (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="date_to", help="по дату заказа включительно (YYYY-MM-DD)")
+    parser.add_argument("-o", "--output", default=OUTPUT_DIR, help="папка для PNG")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="число процессов отрисовки")
+    parser.add_argument("-f", "--force", action="store_true", help="перерисовать даже без изменений данных")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    try:
+        specs = load_chart_specs(conn, args.restaurant, args.date_from, args.date_to)
+    finally:
+        conn.close()
+
+    rendered, skipped = render_charts(specs, args.output, args.workers, args.force)
+    print(f"Графики сохранены в папку '{args.output}': перерисовано {len(rendered)}, без изменений {len(skipped)}")
 
-conn.close()
 
-print("Все графики сохранены в папку 'visualizations'")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
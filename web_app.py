@@ -1,13 +1,25 @@
 import os
+import hmac
+import hashlib
 import bcrypt
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from flask import Flask, render_template, request, redirect, url_for, session, flash, Response
+from flask import Flask, render_template, request, redirect, url_for, session, flash, Response, jsonify, stream_with_context
 from dotenv import load_dotenv
+from itsdangerous import URLSafeSerializer, BadSignature
 from datetime import datetime
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+import time
 import gspread
 from google.oauth2.service_account import Credentials
-from app.security.sql_guard import validate_sql
+from app.security.sql_guard import validate_sql, verdict_cache, register_sql_template, check_sql_template, registered_templates
+from app.security.guard_metrics import guard_metrics
+from app.db.pool import get_pool
+from app.db.schema_cache import get_schema_catalog
+from app.cache.result_store import get_result_store
+from app.cache.chart_cache import get_chart_cache
+from app.db.export import stream_export, export_filename, export_mimetype
 import re
 load_dotenv()
 
@@ -47,28 +59,12 @@ def format_datetime_columns(rows):
 
 
 def get_db_conn():
-
-    return psycopg2.connect(
-        host=os.environ.get("DB_HOST", "localhost"),
-        port=os.environ.get("DB_PORT", "5432"),
-        dbname=os.environ.get("DB_NAME", "restaurant_management"),
-        user=os.environ.get("DB_USER", "restaurant_admin"),
-        password=os.environ.get("DB_PASSWORD", "secure_password_123"),
-    )
+    # соединение берётся из общего пула и возвращается в него при выходе из with
+    return get_pool().connection()
 
 
 def list_tables():
-
-    with get_db_conn() as conn, conn.cursor() as cur:
-        cur.execute(
-            """
-            SELECT table_name
-            FROM information_schema.tables
-            WHERE table_schema = 'public' AND table_type = 'BASE TABLE'
-            ORDER BY table_name
-            """
-        )
-        return [r[0] for r in cur.fetchall()]
+    return get_schema_catalog().tables()
 
 
 def validate_table_name(table_name: str) -> tuple[bool, str]:
@@ -79,8 +75,7 @@ def validate_table_name(table_name: str) -> tuple[bool, str]:
     if not re.match(r'^[a-zA-Z_][a-zA-Z0-9_]*$', table_name):
         return False, f"Недопустимое имя таблицы: {table_name}"
 
-    valid_tables = list_tables()
-    if table_name not in valid_tables:
+    if not get_schema_catalog().has_table(table_name):
         return False, f"Таблица {table_name} не найдена в базе данных"
     
     return True, ""
@@ -95,7 +90,7 @@ def validate_column_names(column_names: list[str], table_name: str) -> tuple[boo
         return False, error
     
     try:
-        valid_columns = [col["column_name"] for col in list_columns(table_name)]
+        valid_columns = get_schema_catalog().column_names(table_name)
     except Exception:
         return False, f"Не удалось получить список колонок для таблицы {table_name}"
     
@@ -166,26 +161,7 @@ def list_columns(table: str):
     if not is_valid:
         raise ValueError(error)
     
-    with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            """
-            SELECT
-                column_name,
-                data_type,
-                is_nullable,
-                column_default,
-                is_identity
-            FROM information_schema.columns
-            WHERE table_schema = 'public' AND table_name = %s
-            ORDER BY ordinal_position
-            """,
-            (table,),
-        )
-        rows = cur.fetchall()
-        for row in rows:
-            default = row.get("column_default") or ""
-            row["is_serial"] = default.startswith("nextval(") or row.get("is_identity") == "YES"
-        return format_datetime_columns(rows)
+    return get_schema_catalog().columns(table)
 
 
 def list_restaurants() -> list[dict]:
@@ -216,55 +192,80 @@ def get_counts() -> dict:
     return counts
 
 
-def get_summary(role: str | None, rest_id: int | None) -> list[dict]:
-    base_sql = """
+# агрегаты отчётов догоняются не чаще раза в REPORT_REFRESH_SECONDS (0 — при каждом чтении)
+REPORT_REFRESH_SECONDS = int(os.environ.get("REPORT_REFRESH_SECONDS", "60"))
+
+
+def refresh_report_rollups(cur) -> str | None:
+    """Пересчитывает агрегаты за изменённые дни, если они устарели; возвращает момент «данные на»."""
+    cur.execute(
+        "SELECT fn_refresh_report_rollups(make_interval(secs => %s)) AS as_of",
+        (REPORT_REFRESH_SECONDS,),
+    )
+    as_of = cur.fetchone()["as_of"]
+    return as_of.strftime('%Y-%m-%d %H:%M:%S') if as_of else None
+
+
+def build_summary_query(role: str | None, rest_id: int | None) -> tuple[str, list]:
+    # заказы и партии агрегируются по отдельности: общий JOIN по restaurant_id дал бы
+    # декартово произведение заказов на партии и завышенные суммы
+    rest_filter = role != "admin" and bool(rest_id)
+    params: list = [rest_id] * 3 if rest_filter else []
+    where_sql = "WHERE {} = %s" if rest_filter else ""
+    sql = f"""
         SELECT
           r.id AS restaurant_id,
           r.name AS restaurant_name,
-          COUNT(DISTINCT o.id) AS orders_count,
-          COALESCE(SUM(o.total_amount), 0) AS orders_sum,
-          COUNT(DISTINCT s.id) AS stocks_count,
-          COALESCE(SUM(s.qty), 0) AS stocks_qty
+          COALESCE(o.orders_count, 0) AS orders_count,
+          COALESCE(o.orders_sum, 0) AS orders_sum,
+          COALESCE(s.stocks_count, 0) AS stocks_count,
+          COALESCE(s.stocks_qty, 0) AS stocks_qty
         FROM restaurants r
-        LEFT JOIN orders o ON o.restaurant_id = r.id
-        LEFT JOIN ingredient_batches s ON s.restaurant_id = r.id
-    """
-    clauses = []
-    params: list = []
-    if role != "admin":
-        if rest_id:
-            clauses.append("r.id = %s")
-            params.append(rest_id)
-    where_sql = (" WHERE " + " AND ".join(clauses)) if clauses else ""
-    sql = f"""
-        {base_sql}
-        {where_sql}
-        GROUP BY r.id, r.name
+        LEFT JOIN (
+            SELECT restaurant_id, SUM(orders_count)::bigint AS orders_count, SUM(total_amount) AS orders_sum
+            FROM report_orders_daily
+            {where_sql.format("restaurant_id")}
+            GROUP BY restaurant_id
+        ) o ON o.restaurant_id = r.id
+        LEFT JOIN (
+            SELECT restaurant_id, COUNT(*) AS stocks_count, SUM(qty) AS stocks_qty
+            FROM ingredient_batches
+            {where_sql.format("restaurant_id")}
+            GROUP BY restaurant_id
+        ) s ON s.restaurant_id = r.id
+        {where_sql.format("r.id")}
         ORDER BY r.id
     """
+    return sql, params
+
+
+def get_summary(role: str | None, rest_id: int | None) -> list[dict]:
+    sql, params = build_summary_query(role, rest_id)
     with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        refresh_report_rollups(cur)
         cur.execute(sql, params)
         rows = cur.fetchall()
         return format_datetime_columns(rows)
 
 
-def get_status_counts(role: str | None, rest_id: int | None) -> list[dict]:
+def get_status_counts(role: str | None, rest_id: int | None) -> tuple[list[dict], str | None]:
     clauses = []
     params: list = []
     if role != "admin" and rest_id:
-        clauses.append("o.restaurant_id = %s")
+        clauses.append("r.restaurant_id = %s")
         params.append(rest_id)
     where_sql = "WHERE " + " AND ".join(clauses) if clauses else ""
     sql = f"""
-        SELECT o.status, COUNT(*) AS cnt
-        FROM orders o
+        SELECT r.status, SUM(r.orders_count)::bigint AS cnt
+        FROM report_orders_daily r
         {where_sql}
-        GROUP BY o.status
-        ORDER BY o.status
+        GROUP BY r.status
+        ORDER BY r.status
     """
     with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        as_of = refresh_report_rollups(cur)
         cur.execute(sql, params)
-        return cur.fetchall()
+        return cur.fetchall(), as_of
 
 
 def list_stocks(restaurant_id: int | None = None) -> list[dict]:
@@ -362,8 +363,9 @@ def list_dishes_filtered(
         params.append(keyword)
     where_sql = "WHERE " + " AND ".join(clauses) if clauses else ""
     sql = f"""
-        SELECT id, restaurant_id, name, category, price, prep_time_minutes, is_available
+        SELECT id, restaurant_id, name, category, price, prep_time_minutes, is_available, s.segment
         FROM dishes
+        LEFT JOIN dish_segments s ON s.dish_id = dishes.id
         {where_sql}
         ORDER BY restaurant_id, name
         LIMIT 200;
@@ -375,17 +377,13 @@ def list_dishes_filtered(
 
 
 def run_report_default():
-    sql = """
-        SELECT restaurant_id, COUNT(*) AS orders_count, SUM(total_amount) AS total_amount
-        FROM orders
-        GROUP BY restaurant_id
-        ORDER BY restaurant_id;
-    """
+    sql, params = build_report_query("orders_per_restaurant", None)
     with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(sql)
+        as_of = refresh_report_rollups(cur)
+        cur.execute(sql, params)
         rows = cur.fetchall()
         cols = list(rows[0].keys()) if rows else [desc.name for desc in cur.description]
-        return cols, rows
+        return cols, rows, as_of
 
 
 def current_user():
@@ -421,6 +419,43 @@ def has_perm(module: str) -> bool:
     role = user.get("role")
     return module in ROLE_PERMISSIONS.get(role, set())
 
+
+RESULT_PAGE_SIZE = int(os.environ.get("RESULT_PAGE_SIZE", "100"))
+
+
+def _result_owner() -> str:
+    user = session.get("user") or {}
+    return str(user.get("id"))
+
+
+def store_result(name: str, cols: list[str], rows: list[dict], **meta) -> None:
+    # в сессии хранится только ссылка на результат, сами строки лежат на сервере
+    store = get_result_store()
+    old = session.get(name)
+    if isinstance(old, dict) and old.get("id"):
+        store.delete(old["id"])
+    result_id = store.put(_result_owner(), cols, rows, meta)
+    session[name] = {"id": result_id, **meta}
+
+
+def drop_result(name: str) -> None:
+    old = session.pop(name, None)
+    if isinstance(old, dict) and old.get("id"):
+        get_result_store().delete(old["id"])
+
+
+def load_result(name: str, page: int = 1) -> dict | None:
+    ref = session.get(name)
+    if not isinstance(ref, dict) or not ref.get("id"):
+        session.pop(name, None)
+        return None
+    result = get_result_store().page(ref["id"], _result_owner(), page, RESULT_PAGE_SIZE)
+    if result is None:
+        session.pop(name, None)
+        return None
+    result.update(result.pop("meta"))
+    return result
+
 @app.route("/", methods=["GET"])
 def index():
     if current_user():
@@ -489,6 +524,8 @@ def login():
 
 @app.route("/logout")
 def logout():
+    for name in RESULT_NAMES:
+        drop_result(name)
     session.clear()
     return redirect(url_for("login"))
 
@@ -518,15 +555,7 @@ def export_all_safe_tables_to_google_sheets():
         spreadsheet = client.open(GOOGLE_SHEETS_CONFIG["spreadsheet_title"])
 
 
-        with get_db_conn() as conn, conn.cursor() as cur:
-            cur.execute("""
-                        SELECT table_name
-                        FROM information_schema.tables
-                        WHERE table_schema = 'public'
-                          AND table_type = 'BASE TABLE'
-                        ORDER BY table_name;
-                        """)
-            all_tables = {row[0] for row in cur.fetchall()}
+        all_tables = set(list_tables())
 
         safe_tables = sorted(all_tables - SENSITIVE_TABLES)
 
@@ -576,77 +605,231 @@ def action_export_all_safe_tables():
     flash(msg, "success" if success else "danger")
     return redirect(url_for("dashboard") + "#tab-reports")
 
+@app.route("/api/db/pool")
+@login_required
+def api_db_pool_stats():
+    if not has_perm("admin"):
+        return "Доступ запрещён", 403
+    return jsonify(get_pool().stats())
+
+
+@app.route("/api/security/guard")
+@login_required
+def api_security_guard_stats():
+    if not has_perm("admin"):
+        return "Доступ запрещён", 403
+    return jsonify({
+        "verdict_cache": verdict_cache.stats(),
+        "templates": registered_templates(),
+        "metrics": guard_metrics.to_dict(),
+    })
+
+
+@app.route("/metrics")
+def metrics():
+    # Prometheus не умеет логиниться: кроме сессии админа принимается токен METRICS_TOKEN
+    token = os.environ.get("METRICS_TOKEN")
+    auth = request.headers.get("Authorization", "")
+    token_ok = bool(token) and hmac.compare_digest(auth.encode("utf-8"), f"Bearer {token}".encode("utf-8"))
+    if not token_ok and not has_perm("admin"):
+        return "Доступ запрещён", 403
+    return Response(guard_metrics.to_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+def get_restaurant_name(rest_id: int) -> str:
+    with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute("SELECT name FROM restaurants WHERE id = %s", (rest_id,))
+        row = cur.fetchone()
+        return row["name"] if row else "—"
+
+
+def list_roles() -> list[str]:
+    with get_db_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT name FROM app_roles ORDER BY name")
+        return [r[0] for r in cur.fetchall()]
+
+
+def load_tables_form_columns(form: dict | None) -> list[dict] | None:
+    if not form or not form.get("table"):
+        return None
+    is_valid, _ = validate_table_name(form["table"])
+    if not is_valid:
+        return None
+    return list_columns(form["table"])
+
+
+@dataclass
+class DashboardData:
+    current_restaurant_name: str = "Не назначен"
+    restaurants: list[dict] = field(default_factory=list)
+    roles: list[str] = field(default_factory=list)
+    tables: list[str] = field(default_factory=list)
+    tables_form_columns: list[dict] | None = None
+    stocks_last: list[dict] | None = None
+    orders_last: list[dict] | None = None
+    menu_last: list[dict] | None = None
+    report_last: dict | None = None
+    stats: dict = field(default_factory=lambda: {"orders": 0, "stocks": 0, "dishes": 0})
+    summary: list[dict] = field(default_factory=list)
+    status_counts: list[dict] = field(default_factory=list)
+    reports_as_of: str | None = None
+    purchase_requests: list[dict] = field(default_factory=list)
+    timings: dict[str, float] = field(default_factory=dict)
+    errors: dict[str, str] = field(default_factory=dict)
+
+
+# независимые секции дашборда выполняются параллельно, каждая на своём соединении из пула
+_dashboard_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("DASHBOARD_WORKERS", "4")),
+    thread_name_prefix="dashboard",
+)
+
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    try:
+        return func(*args), None, time.perf_counter() - started
+    except Exception as ex:
+        return None, ex, time.perf_counter() - started
+
+
+def dashboard_sections(role: str | None, rest_id: int | None, tables_form: dict | None, cached: dict) -> dict:
+    """Независимые секции дашборда: имя -> (функция, *аргументы)."""
+    sections = {
+        "stats": (get_counts,),
+        "tables": (list_tables,),
+        "roles": (list_roles,),
+        "tables_form": (load_tables_form_columns, tables_form),
+        "summary": (get_summary, role, rest_id),
+        "status_counts": (get_status_counts, role, rest_id),
+        "purchase_requests": (list_purchase_requests, rest_id),
+    }
+    if rest_id:
+        sections["current_restaurant_name"] = (get_restaurant_name, rest_id)
+    if not cached.get("report_last"):
+        sections["report_last"] = (run_report_default,)
+    return sections
+
+
+def dependent_sections(cached: dict, default_rest: int | None) -> dict:
+    """Секции, которым нужен ресторан по умолчанию из списка ресторанов."""
+    dependent = {}
+    if not cached.get("stocks_last") and default_rest:
+        dependent["stocks_last"] = (list_stocks, default_rest)
+    if not cached.get("orders_last") and default_rest:
+        dependent["orders_last"] = (list_orders, default_rest, None)
+    if not cached.get("menu_last"):
+        dependent["menu_last"] = (list_dishes_filtered, default_rest, None, None, None, None, None)
+    return dependent
+
+
+def load_dashboard_data(
+    role: str | None,
+    rest_id: int | None,
+    tables_form: dict | None,
+    cached: dict,
+) -> DashboardData:
+    data = DashboardData()
+    started = time.perf_counter()
+
+    sections = dashboard_sections(role, rest_id, tables_form, cached)
+    futures = {name: _dashboard_executor.submit(_timed, *call) for name, call in sections.items()}
+
+    # ресторан по умолчанию нужен для запасов/заказов/меню, поэтому список ресторанов грузится сразу
+    restaurants, error, elapsed = _timed(list_restaurants)
+    data.timings["restaurants"] = elapsed
+    if error:
+        data.errors["restaurants"] = str(error)
+    else:
+        data.restaurants = restaurants
+    default_rest = data.restaurants[0]["id"] if data.restaurants else None
+    dependent = dependent_sections(cached, default_rest)
+    futures.update({name: _dashboard_executor.submit(_timed, *call) for name, call in dependent.items()})
+
+    for name, future in futures.items():
+        result, error, elapsed = future.result()
+        data.timings[name] = elapsed
+        if error:
+            data.errors[name] = str(error)
+            continue
+        if name == "tables_form":
+            data.tables_form_columns = result
+        elif name == "report_last":
+            cols, rows, as_of = result
+            data.report_last = {"cols": cols, "rows": rows, "key": "orders_per_restaurant", "as_of": as_of}
+        elif name == "status_counts":
+            data.status_counts, data.reports_as_of = result
+        else:
+            setattr(data, name, result)
+    data.timings["total"] = time.perf_counter() - started
+    return data
+
+
+RESULT_NAMES = ("query_last", "tables_last", "stocks_last", "orders_last", "menu_last", "report_last")
+
+
 @app.route("/dashboard")
 @login_required
 def dashboard():
     user = current_user()
+    # страница каждого результата задаётся параметром page_<имя>, например ?page_orders=2
+    results = {
+        name: load_result(name, request.args.get(f"page_{name[:-len('_last')]}", 1, type=int))
+        for name in RESULT_NAMES
+    }
+    loaded = load_dashboard_data(
+        user["role"],
+        user.get("restaurant_id"),
+        session.get("tables_form"),
+        {name: result is not None for name, result in results.items()},
+    )
     data = {
         "permissions": ROLE_PERMISSIONS.get(user["role"], set()),
         "role": user["role"],
         "username": user["username"],
         "current_restaurant": user.get("restaurant_id"),
+        "current_restaurant_name": loaded.current_restaurant_name,
+        "restaurants": loaded.restaurants,
+        "roles": loaded.roles,
+        "tables": loaded.tables,
         "tables_form": session.get("tables_form"),
-        "stocks_last": session.get("stocks_last"),
-        "orders_last": session.get("orders_last"),
-        "menu_last": session.get("menu_last"),
-        "report_last": session.get("report_last"),
-        "stats": get_counts(),
-        "summary": [],
-        "status_counts": [],
+        "stats": loaded.stats,
+        "summary": loaded.summary,
+        "status_counts": loaded.status_counts,
+        "reports_as_of": loaded.reports_as_of,
+        "purchase_requests": loaded.purchase_requests,
+        "timings": {name: round(sec * 1000, 1) for name, sec in loaded.timings.items()},
     }
-    current_rest_id = user.get("restaurant_id")
-    current_rest_name = None
-    if current_rest_id:
-        with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT name FROM restaurants WHERE id = %s", (current_rest_id,))
-            row = cur.fetchone()
-            current_rest_name = row["name"] if row else "—"
-    else:
-        current_rest_name = "Не назначен"
-
-    data["current_restaurant_name"] = current_rest_name
-    try:
-        with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT id, name FROM restaurants ORDER BY id")
-            data["restaurants"] = cur.fetchall()
-            cur.execute("SELECT name FROM app_roles ORDER BY name")
-            data["roles"] = [r["name"] for r in cur.fetchall()]
-            data["tables"] = list_tables()
-            form = data["tables_form"]
-            if form and form.get("table"):
-                table_name = form["table"]
-                is_valid, error = validate_table_name(table_name)
-                if is_valid:
-                    form["columns"] = list_columns(table_name)
-                    session["tables_form"] = form
-                else:
-                    session.pop("tables_form", None)
-            default_rest = data["restaurants"][0]["id"] if data["restaurants"] else None
-            if not data["stocks_last"] and default_rest:
-                data["stocks_last"] = list_stocks(default_rest)
-                session["stocks_last"] = data["stocks_last"]
-            if not data["orders_last"] and default_rest:
-                data["orders_last"] = list_orders(default_rest, None)
-                session["orders_last"] = data["orders_last"]
-            if not data["menu_last"]:
-                data["menu_last"] = list_dishes_filtered(default_rest, None, None, None, None, None)
-                session["menu_last"] = data["menu_last"]
-            if not data["report_last"]:
-                cols, rows = run_report_default()
-                data["report_last"] = {"cols": cols, "rows": rows, "key": "orders_per_restaurant"}
-                session["report_last"] = data["report_last"]
-            data["summary"] = get_summary(user["role"], data["current_restaurant"])
-            data["status_counts"] = get_status_counts(user["role"], data["current_restaurant"])
-            data["purchase_requests"] = list_purchase_requests(data["current_restaurant"])
-    except Exception as ex:
-        flash(f"Ошибка загрузки справочников: {ex}", "danger")
-        data["restaurants"] = []
-        data["roles"] = []
-        data["tables"] = []
-    return render_template("dashboard.html", **data)
+    form = data["tables_form"]
+    if form and form.get("table"):
+        if loaded.tables_form_columns is not None:
+            form["columns"] = loaded.tables_form_columns
+            session["tables_form"] = form
+        elif "tables_form" not in loaded.errors:
+            session.pop("tables_form", None)
+    default_rest = loaded.restaurants[0]["id"] if loaded.restaurants else None
+    for name in ("stocks_last", "orders_last", "menu_last"):
+        rows = getattr(loaded, name)
+        if rows is not None:
+            meta = {"rest_id": default_rest} if name == "stocks_last" else {}
+            store_result(name, list(rows[0].keys()) if rows else [], rows, **meta)
+            results[name] = load_result(name)
+    if loaded.report_last is not None:
+        report = loaded.report_last
+        store_result("report_last", report["cols"], report["rows"], key=report["key"], as_of=report["as_of"])
+        results["report_last"] = load_result("report_last")
+    data.update(results)
+    if loaded.errors:
+        flash(f"Ошибка загрузки справочников: {'; '.join(dict.fromkeys(loaded.errors.values()))}", "danger")
+
+    response = app.make_response(render_template("dashboard.html", **data))
+    response.headers["Server-Timing"] = ", ".join(
+        f"{name};dur={ms}" for name, ms in data["timings"].items()
+    )
+    return response
 
 
-def fetch_table(table: str, where: str | None, limit: int):
+def _validate_table_query(table: str, where: str | None) -> None:
     is_valid, error = validate_table_name(table)
     if not is_valid:
         raise ValueError(error)
@@ -657,6 +840,18 @@ def fetch_table(table: str, where: str | None, limit: int):
             raise ValueError(error)
         if where.count("'") > 10 or where.count('"') > 10:
             raise ValueError("WHERE условие содержит слишком много кавычек")
+
+
+def _check_generated_sql(sql: str, template: str | None = None) -> None:
+    # template — имя для запросов без пользовательского условия: вердикт берётся из реестра шаблонов
+    final_result = check_sql_template(template, sql) if template else validate_sql(sql)
+    if not final_result["allowed"]:
+        reason = final_result.get("reason", final_result.get("risk_score", "Неизвестная причина"))
+        raise ValueError(f"Сгенерированный SQL запрос заблокирован: {reason}")
+
+
+def fetch_table(table: str, where: str | None, limit: int):
+    _validate_table_query(table, where)
     
     limit = min(max(1, limit), 5000)
     
@@ -667,10 +862,7 @@ def fetch_table(table: str, where: str | None, limit: int):
     sql += " ORDER BY 1 LIMIT %s"
     params.append(limit)
     
-    final_result = validate_sql(sql)
-    if not final_result["allowed"]:
-        reason = final_result.get("reason", final_result.get("risk_score", "Неизвестная причина"))
-        raise ValueError(f"Сгенерированный SQL запрос заблокирован: {reason}")
+    _check_generated_sql(sql, None if where else f"{table}:rows")
     
     with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute(sql, params)
@@ -679,6 +871,179 @@ def fetch_table(table: str, where: str | None, limit: int):
         return cols, format_datetime_columns(rows)
 
 
+TABLE_PAGE_MAX = 1000
+_page_tokens = URLSafeSerializer(app.secret_key, salt="tables-page")
+
+
+def count_table_rows(table: str, where: str | None, mode: str) -> int | None:
+    # estimate: pg_class.reltuples без фильтра, оценка планировщика с фильтром; exact: COUNT(*)
+    if mode not in ("estimate", "exact"):
+        return None
+    with get_db_conn() as conn, conn.cursor() as cur:
+        if mode == "exact":
+            sql = f"SELECT COUNT(*) FROM public.{table}" + (f" WHERE {where}" if where else "")
+            _check_generated_sql(sql, None if where else f"{table}:count")
+            cur.execute(sql)
+            return cur.fetchone()[0]
+        if not where:
+            cur.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                (f"public.{table}",),
+            )
+            row = cur.fetchone()
+            if row and row[0] >= 0:
+                return row[0]
+        sql = f"SELECT * FROM public.{table}" + (f" WHERE {where}" if where else "")
+        _check_generated_sql(sql, None if where else f"{table}:scan")
+        cur.execute(f"EXPLAIN (FORMAT JSON) {sql}")
+        plan = cur.fetchone()[0]
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+
+def _table_page_key(table: str) -> list[str]:
+    pk = get_schema_catalog().primary_key(table)
+    if not pk or not all(re.match(r'^[a-zA-Z_][a-zA-Z0-9_]*$', col) for col in pk):
+        return []
+    return pk
+
+
+def _table_page_sql(table: str, pk: list[str], where: str | None, direction: str, keyed: bool) -> str:
+    clauses = [f"({where})"] if where else []
+    if pk:
+        pk_list = ", ".join(pk)
+        if keyed:
+            op = ">" if direction == "next" else "<"
+            clauses.append(f"({pk_list}) {op} ({', '.join(['%s'] * len(pk))})")
+        order = ", ".join(f"{col} {'DESC' if direction == 'prev' else 'ASC'}" for col in pk)
+    else:
+        # без первичного ключа остаётся только OFFSET
+        order = "1"
+    sql = f"SELECT * FROM public.{table}"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += f" ORDER BY {order} LIMIT %s"
+    if not pk:
+        sql += " OFFSET %s"
+    return sql
+
+
+def _table_page_template(table: str, direction: str, keyed: bool) -> str:
+    return f"{table}:page_{direction}" + ("_key" if keyed else "")
+
+
+def _table_insert_sql(table: str, cols: list[str]) -> str:
+    return f"INSERT INTO public.{table} ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))})"
+
+
+def _table_templates(table: str) -> dict[str, str]:
+    """Запросы вкладки таблиц без пользовательского условия: их текст зависит только
+    от таблицы, её первичного ключа и колонок."""
+    pk = _table_page_key(table)
+    templates = {
+        f"{table}:rows": f"SELECT * FROM public.{table} ORDER BY 1 LIMIT %s",
+        f"{table}:count": f"SELECT COUNT(*) FROM public.{table}",
+        f"{table}:scan": f"SELECT * FROM public.{table}",
+        f"{table}:export": f"SELECT * FROM public.{table} ORDER BY 1",
+    }
+    for direction in ("next", "prev"):
+        for keyed in (False, True):
+            templates[_table_page_template(table, direction, keyed)] = _table_page_sql(
+                table, pk, None, direction, bool(pk) and keyed
+            )
+    catalog = get_schema_catalog()
+    serial = set(catalog.serial_columns(table))
+    cols = [col["column_name"] for col in catalog.columns(table) if col["column_name"] not in serial]
+    if cols and all(re.match(r'^[a-zA-Z_][a-zA-Z0-9_]*$', col) for col in cols):
+        templates[f"{table}:insert({','.join(cols)})"] = _table_insert_sql(table, cols)
+    return templates
+
+
+def register_table_templates() -> int:
+    """Проверяет шаблоны всех таблиц схемы один раз при старте. Шаблоны таблиц,
+    появившихся позже, и вставки с другим набором колонок регистрируются при первом запросе."""
+    registered = 0
+    for table in get_schema_catalog().tables():
+        if not re.match(r'^[a-zA-Z_][a-zA-Z0-9_]*$', table):
+            continue
+        for name, sql in _table_templates(table).items():
+            register_sql_template(name, sql)
+            registered += 1
+    return registered
+
+
+def fetch_table_page(
+    table: str,
+    where: str | None,
+    page_size: int,
+    cursor: str | None = None,
+    count_mode: str = "none",
+) -> dict:
+    """Страница таблицы с keyset-пагинацией по первичному ключу.
+
+    cursor — токен next/prev из предыдущей страницы; без него читается первая страница.
+    """
+    _validate_table_query(table, where)
+    page_size = min(max(1, page_size), TABLE_PAGE_MAX)
+
+    direction, key, offset = "next", None, 0
+    if cursor:
+        try:
+            token = _page_tokens.loads(cursor)
+        except BadSignature:
+            raise ValueError("Недопустимый токен страницы")
+        if token.get("table") != table or token.get("where") != where:
+            raise ValueError("Токен страницы относится к другому запросу")
+        direction, key, offset = token["dir"], token.get("key"), token.get("offset", 0)
+
+    pk = _table_page_key(table)
+    params: list = []
+    if pk and key is not None:
+        params.extend(key)
+    params.append(page_size + 1)
+    if not pk:
+        params.append(offset)
+    sql = _table_page_sql(table, pk, where, direction, bool(pk) and key is not None)
+
+    _check_generated_sql(sql, None if where else _table_page_template(table, direction, key is not None))
+
+    with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(sql, params)
+        rows = cur.fetchall()
+        cols = list(rows[0].keys()) if rows else [d.name for d in cur.description]
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == "prev":
+        rows.reverse()
+
+    def make_token(dir_: str, row: dict | None = None, new_offset: int = 0) -> str:
+        payload = {"table": table, "where": where, "dir": dir_, "offset": new_offset}
+        if row is not None:
+            payload["key"] = [str(row[col]) if not isinstance(row[col], (int, float)) else row[col] for col in pk]
+        return _page_tokens.dumps(payload)
+
+    if pk:
+        at_start = key is None or (direction == "prev" and not has_more)
+        at_end = (direction == "next" and not has_more) or not rows
+        if direction == "prev" and not rows:
+            at_start, at_end = True, False
+        next_token = make_token("next", rows[-1]) if rows and not at_end else None
+        prev_token = make_token("prev", rows[0]) if rows and not at_start else None
+    else:
+        next_token = make_token("next", new_offset=offset + page_size) if has_more else None
+        prev_token = make_token("next", new_offset=max(offset - page_size, 0)) if offset > 0 else None
+
+    return {
+        "cols": cols,
+        "rows": format_datetime_columns(rows),
+        "next_token": next_token,
+        "prev_token": prev_token,
+        "total": count_table_rows(table, where, count_mode),
+        "total_is_estimate": count_mode == "estimate",
+        "keyset": bool(pk),
+    }
+
+
 @app.post("/action/tables/view")
 @login_required
 def action_tables_view():
@@ -694,10 +1059,49 @@ def action_tables_view():
         flash("Укажите имя таблицы", "warning")
         return redirect(url_for("dashboard") + "#tab-tables")
     where = request.form.get("where") or None
-    limit = int(request.form.get("limit") or 200)
+    page_size = int(request.form.get("limit") or 200)
+    count_mode = request.form.get("count") or "none"
+    session["tables_view"] = {"table": table, "where": where, "page_size": page_size, "count": count_mode}
+    try:
+        page = fetch_table_page(table, where, page_size, count_mode=count_mode)
+        _store_table_page(table, page)
+    except Exception as ex:
+        flash(f"Ошибка чтения таблицы: {ex}", "danger")
+    return redirect(url_for("dashboard") + "#tab-tables")
+
+
+def _store_table_page(table: str, page: dict) -> None:
+    store_result(
+        "tables_last",
+        page["cols"],
+        page["rows"],
+        table=table,
+        next_token=page["next_token"],
+        prev_token=page["prev_token"],
+        total_rows=page["total"],
+        total_is_estimate=page["total_is_estimate"],
+    )
+
+
+@app.get("/action/tables/page")
+@login_required
+def action_tables_page():
+    if not has_perm("tables"):
+        flash("Нет доступа к таблицам", "warning")
+        return redirect(url_for("dashboard") + "#tab-tables")
+    view = session.get("tables_view")
+    cursor = request.args.get("cursor")
+    if not view or not cursor:
+        return redirect(url_for("dashboard") + "#tab-tables")
     try:
-        cols, rows = fetch_table(table, where, limit)
-        session["tables_last"] = {"table": table, "cols": cols, "rows": rows}
+        # точный COUNT(*) считается один раз при загрузке таблицы, при листании — только оценка
+        count_mode = "estimate" if view["count"] != "none" else "none"
+        page = fetch_table_page(view["table"], view["where"], view["page_size"], cursor, count_mode)
+        if view["count"] == "exact":
+            old = load_result("tables_last") or {}
+            if old.get("total_rows") is not None:
+                page["total"], page["total_is_estimate"] = old["total_rows"], False
+        _store_table_page(view["table"], page)
     except Exception as ex:
         flash(f"Ошибка чтения таблицы: {ex}", "danger")
     return redirect(url_for("dashboard") + "#tab-tables")
@@ -731,12 +1135,10 @@ def action_tables_insert():
         if not is_valid:
             raise ValueError(error)
         
-        placeholders = ", ".join(["%s"] * len(cols))
-        col_list = ", ".join(cols)
-        sql = f"INSERT INTO public.{table} ({col_list}) VALUES ({placeholders})"
+        sql = _table_insert_sql(table, cols)
         
-        # Финальная проверка через guard систему
-        final_result = validate_sql(sql)
+        # Финальная проверка через guard систему: форма запроса фиксирована таблицей и колонками
+        final_result = check_sql_template(f"{table}:insert({','.join(cols)})", sql)
         if not final_result["allowed"]:
             reason = final_result.get("reason", final_result.get("risk_score", "Неизвестная причина"))
             raise ValueError(f"SQL запрос заблокирован: {reason}")
@@ -851,14 +1253,12 @@ def action_query_run():
                 rows = cur.fetchall()
                 cols = list(rows[0].keys()) if rows else [d.name for d in cur.description]
 
-                session["query_last"] = {
-                    "cols": cols,
-                    "rows": rows
-                }
+                store_result("query_last", cols, rows, sql=sql)
                 flash(f"Результат: {len(rows)} строк", "success")
             else:
                 flash(f"OK, изменено строк: {cur.rowcount}", "success")
-                session["query_last"] = None
+                drop_result("query_last")
+                get_schema_catalog().invalidate()
 
     except Exception as ex:
         flash(f"Ошибка запроса: {ex}", "danger")
@@ -886,6 +1286,34 @@ def action_context_set():
     return redirect(url_for("dashboard") + "#tab-help")
 
 
+BULK_BATCH_UPDATE_SQL = """
+    WITH changed AS (
+        UPDATE ingredient_batches b
+        SET qty = COALESCE(%(qty)s, b.qty),
+            expiry_date = COALESCE(%(expiry)s::date, b.expiry_date)
+        FROM ingredient_batches old
+        WHERE old.id = b.id AND b.id = ANY(%(ids)s)
+        RETURNING b.id, b.ingredient_id, b.restaurant_id, old.qty AS old_qty, b.qty, b.expiry_date
+    ), moved AS (
+        INSERT INTO inventory_movements (batch_id, ingredient_id, restaurant_id, change_qty, reason)
+        SELECT id, ingredient_id, restaurant_id, qty - old_qty, 'stocktake'
+        FROM changed
+        WHERE qty IS DISTINCT FROM old_qty
+        RETURNING batch_id
+    )
+    SELECT c.*, EXISTS (SELECT 1 FROM moved m WHERE m.batch_id = c.id) AS movement_logged
+    FROM changed c
+    ORDER BY c.id
+"""
+
+
+def bulk_update_batches(batch_ids: list[int], qty: float | None, expiry: str | None) -> list[dict]:
+    # одно выражение на все партии; изменение количества сразу пишется в inventory_movements
+    with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(BULK_BATCH_UPDATE_SQL, {"ids": batch_ids, "qty": qty, "expiry": expiry})
+        return cur.fetchall()
+
+
 @app.post("/action/inventory/update")
 @login_required
 def action_inventory_update():
@@ -901,40 +1329,17 @@ def action_inventory_update():
         return redirect(url_for("dashboard") + "#tab-inv")
     try:
         qty_val = float(qty) if qty else None
-        sets = []
-        params = []
-        if qty_val is not None:
-            sets.append("qty = %s")
-            params.append(qty_val)
-        if expiry:
-            sets.append("expiry_date = %s")
-            params.append(expiry)
-        if not sets:
+        if qty_val is None and not expiry:
             flash("Нет данных для обновления", "info")
             return redirect(url_for("dashboard") + "#tab-inv")
-        valid_update_columns = {'qty', 'expiry_date', 'min_threshold', 'active', 'batch_no'}
-        for set_part in sets:
-            col_match = re.match(r'^(\w+)\s*=', set_part)
-            if not col_match:
-                raise ValueError(f"Недопустимый формат SET: {set_part}")
-            col_name = col_match.group(1)
-            if col_name not in valid_update_columns:
-                raise ValueError(f"Колонка {col_name} не может быть обновлена через этот эндпоинт")
-        
-        update_sql_template = f"UPDATE ingredient_batches SET {', '.join(sets)} WHERE id = %s"
-        
-        test_sql = update_sql_template.replace('%s', '1')
-        final_result = validate_sql(test_sql)
-        if not final_result["allowed"]:
-            reason = final_result.get("reason", final_result.get("risk_score", "Неизвестная причина"))
-            raise ValueError(f"UPDATE запрос заблокирован: {reason}")
-        
-        with get_db_conn() as conn, conn.cursor() as cur:
-            for sid in stock_ids:
-                if not str(sid).isdigit():
-                    raise ValueError(f"Недопустимый ID: {sid}")
-                cur.execute(update_sql_template, [*params, int(sid)])
-        flash("Запасы обновлены", "success")
+        changed = bulk_update_batches([int(sid) for sid in stock_ids], qty_val, expiry)
+        logged = sum(1 for row in changed if row["movement_logged"])
+        flash(f"Запасы обновлены: партий {len(changed)}, записей в журнале движений {logged}", "success")
+        stocks = session.get("stocks_last")
+        if stocks is not None:
+            rest_id = stocks.get("rest_id")
+            rows = list_stocks(int(rest_id) if rest_id else None)
+            store_result("stocks_last", list(rows[0].keys()) if rows else [], rows, rest_id=rest_id)
     except Exception as ex:
         flash(f"Ошибка обновления: {ex}", "danger")
     return redirect(url_for("dashboard") + "#tab-inv")
@@ -949,12 +1354,30 @@ def action_inventory_load():
     rest_id = request.form.get("rest_id") or None
     try:
         rows = list_stocks(int(rest_id)) if rest_id else list_stocks(None)
-        session["stocks_last"] = rows
+        store_result("stocks_last", list(rows[0].keys()) if rows else [], rows, rest_id=rest_id)
     except Exception as ex:
         flash(f"Ошибка загрузки запасов: {ex}", "danger")
     return redirect(url_for("dashboard") + "#tab-inv")
 
 
+# одна заявка на (ресторан, ингредиент) среди выбранных партий, без дублей к открытым заявкам
+PURCHASE_REQUESTS_FOR_BATCHES_SQL = """
+    INSERT INTO purchase_requests (restaurant_id, ingredient_id, qty, status)
+    SELECT b.restaurant_id, b.ingredient_id,
+           COALESCE(%(qty)s, NULLIF(MAX(b.min_threshold), 0), 1), 'new'
+    FROM ingredient_batches b
+    WHERE b.id = ANY(%(ids)s)
+      AND NOT EXISTS (
+          SELECT 1 FROM purchase_requests pr
+          WHERE pr.restaurant_id = b.restaurant_id
+            AND pr.ingredient_id = b.ingredient_id
+            AND pr.status IN ('new', 'ordered')
+      )
+    GROUP BY b.restaurant_id, b.ingredient_id
+    ON CONFLICT (restaurant_id, ingredient_id) WHERE status IN ('new', 'ordered') DO NOTHING
+"""
+
+
 @app.post("/action/inventory/request")
 @login_required
 def action_inventory_request():
@@ -969,22 +1392,88 @@ def action_inventory_request():
         return redirect(url_for("dashboard") + "#tab-inv")
     try:
         qty_val = float(qty) if qty else None
-        with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute(
-                "SELECT id, restaurant_id, ingredient_id, min_threshold FROM ingredient_batches WHERE id = ANY(%s)",
-                (list(map(int, stock_ids)),))
-            rows = cur.fetchall()
-            for row in rows:
-                qty_to_use = qty_val if qty_val is not None else (row["min_threshold"] or 1)
-                cur.execute(
-                    "INSERT INTO purchase_requests(restaurant_id, ingredient_id, qty, status) VALUES (%s, %s, %s, 'new')",
-                    (row["restaurant_id"], row["ingredient_id"], qty_to_use),
-                )
-        flash("Заявки созданы", "success")
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute(PURCHASE_REQUESTS_FOR_BATCHES_SQL, {"ids": list(map(int, stock_ids)), "qty": qty_val})
+            created = cur.rowcount
+        if created:
+            flash(f"Заявки созданы: {created}", "success")
+        else:
+            flash("По выбранным ингредиентам уже есть открытые заявки", "info")
     except Exception as ex:
         flash(f"Ошибка заявки: {ex}", "danger")
     return redirect(url_for("dashboard") + "#tab-inv")
 
+
+def _replenish_scope() -> tuple[bool, int | None]:
+    # вся сеть (None) — только для администратора, остальные работают со своим рестораном
+    if has_perm("admin"):
+        rest_id = request.form.get("rest_id") or None
+    else:
+        rest_id = current_user().get("restaurant_id")
+        if not rest_id:
+            flash("Не задан ресторан пользователя", "warning")
+            return False, None
+    return True, int(rest_id) if rest_id else None
+
+
+@app.post("/action/inventory/replenish")
+@login_required
+def action_inventory_replenish():
+    if not has_perm("inventory"):
+        flash("Нет доступа", "warning")
+        return redirect(url_for("dashboard") + "#tab-inv")
+    ok, rest_id = _replenish_scope()
+    if not ok:
+        return redirect(url_for("dashboard") + "#tab-inv")
+    try:
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT fn_generate_purchase_requests(%s)", (rest_id,))
+            created = cur.fetchone()[0]
+        flash(f"Автозаявки по остаткам: создано {created}", "success")
+    except Exception as ex:
+        flash(f"Ошибка автозаявок: {ex}", "danger")
+    return redirect(url_for("dashboard") + "#tab-inv")
+
+
+@app.post("/action/inventory/plan")
+@login_required
+def action_inventory_plan():
+    if not has_perm("inventory"):
+        flash("Нет доступа", "warning")
+        return redirect(url_for("dashboard") + "#tab-inv")
+    ok, rest_id = _replenish_scope()
+    if not ok:
+        return redirect(url_for("dashboard") + "#tab-inv")
+    days = (request.form.get("days") or "7").strip()
+    if not days.isdigit() or not 1 <= int(days) <= 60:
+        flash("Горизонт планирования — от 1 до 60 дней", "warning")
+        return redirect(url_for("dashboard") + "#tab-inv")
+    try:
+        with get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT fn_forecast_coverage_days(%s)", (rest_id,))
+            coverage = cur.fetchone()[0]
+            if int(days) > coverage:
+                flash(
+                    f"Прогноз спроса есть только на {coverage} дн. вперёд — уменьшите горизонт "
+                    f"или пересчитайте прогноз (clastering.py --horizon {days})",
+                    "warning",
+                )
+                return redirect(url_for("dashboard") + "#tab-inv")
+            cur.execute(
+                "SELECT created, updated, blocked FROM fn_plan_purchase_requests(%s, %s)", (rest_id, int(days))
+            )
+            created, updated, blocked = cur.fetchone()
+        flash(f"Заявки по прогнозу на {days} дн.: создано {created}, пересчитано {updated}", "success")
+        if blocked:
+            flash(
+                f"Ещё {blocked} ингредиент(ов) не хватает сверх уже заказанного: дозаказ будет оформлен "
+                f"повторным планированием после закрытия заказанной заявки",
+                "warning",
+            )
+    except Exception as ex:
+        flash(f"Ошибка планирования закупок: {ex}", "danger")
+    return redirect(url_for("dashboard") + "#tab-inv")
+
 def list_purchase_requests(restaurant_id: int | None = None) -> list[dict]:
     clauses = []
     params = []
@@ -1014,7 +1503,7 @@ def action_orders_load():
     status = request.form.get("status") or None
     try:
         rows = list_orders(int(rest), status) if rest else list_orders(None, status)
-        session["orders_last"] = rows
+        store_result("orders_last", list(rows[0].keys()) if rows else [], rows)
     except Exception as ex:
         flash(f"Ошибка загрузки заказов: {ex}", "danger")
     return redirect(url_for("dashboard") + "#tab-orders")
@@ -1071,19 +1560,32 @@ def action_orders_add_item():
         flash("Нет доступа", "warning")
         return redirect(url_for("dashboard") + "#tab-orders")
     order_id = request.form.get("order_id")
-    dish_id = request.form.get("dish_id")
-    qty = request.form.get("qty")
-    price = request.form.get("price")
     try:
+        # форма может прислать несколько строк: dish_id/qty/price повторяются
+        lines = [
+            (int(dish_id), int(qty or 1), float(price) if price else None)
+            for dish_id, qty, price in zip(
+                request.form.getlist("dish_id"), request.form.getlist("qty"), request.form.getlist("price")
+            )
+            if dish_id.strip()
+        ]
+        if not lines:
+            flash("Укажите хотя бы одно блюдо", "warning")
+            return redirect(url_for("dashboard") + "#tab-orders")
+        dish_ids, qtys, prices = (list(col) for col in zip(*lines))
         with get_db_conn() as conn, conn.cursor() as cur:
+            # все строки одним INSERT: сумма заказа пересчитывается триггером один раз
             cur.execute(
                 """
                 INSERT INTO order_items(order_id, dish_id, qty, price_at_order)
-                VALUES (%s, %s, %s, %s)
+                SELECT %s, i.dish_id, i.qty, COALESCE(i.price, d.price)
+                FROM unnest(%s::int[], %s::int[], %s::numeric[]) WITH ORDINALITY AS i(dish_id, qty, price, n)
+                LEFT JOIN dishes d ON d.id = i.dish_id
+                ORDER BY i.n
                 """,
-                (order_id, int(dish_id), int(qty), float(price)),
+                (order_id, dish_ids, qtys, prices),
             )
-        flash("Позиция добавлена", "success")
+        flash("Позиция добавлена" if len(lines) == 1 else f"Позиции добавлены: {len(lines)}", "success")
     except Exception as ex:
         flash(f"Ошибка добавления позиции: {ex}", "danger")
     return redirect(url_for("dashboard") + "#tab-orders")
@@ -1123,8 +1625,9 @@ def action_menu_filter():
         params.append(f"%{keyword}%")
     where_sql = "WHERE " + " AND ".join(clauses) if clauses else ""
     sql = f"""
-        SELECT id, restaurant_id, name, category, price, prep_time_minutes, is_available
+        SELECT id, restaurant_id, name, category, price, prep_time_minutes, is_available, s.segment
         FROM dishes
+        LEFT JOIN dish_segments s ON s.dish_id = dishes.id
         {where_sql}
         ORDER BY restaurant_id, name
         LIMIT 200
@@ -1133,12 +1636,68 @@ def action_menu_filter():
         with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
             cur.execute(sql, params)
             rows = cur.fetchall()
-            session["menu_last"] = format_datetime_columns(rows)
+            rows = format_datetime_columns(rows)
+            store_result("menu_last", list(rows[0].keys()) if rows else [], rows)
     except Exception as ex:
         flash(f"Ошибка меню: {ex}", "danger")
     return redirect(url_for("dashboard") + "#tab-menu")
 
 
+# отчёты по заказам читают агрегаты report_*_daily (см. fn_refresh_report_rollups)
+REPORT_QUERIES = {
+    "orders_per_restaurant": (
+        "SELECT restaurant_id, SUM(orders_count)::bigint AS orders_count, SUM(total_amount) AS total_amount "
+        "FROM report_orders_daily {where} GROUP BY restaurant_id ORDER BY restaurant_id",
+        "restaurant_id",
+    ),
+    "top_dishes": (
+        """
+                SELECT d.restaurant_id, d.name, SUM(r.qty)::bigint AS total_qty
+                FROM report_dish_daily r JOIN dishes d ON d.id = r.dish_id
+                {where}
+                GROUP BY d.restaurant_id, d.name
+                ORDER BY total_qty DESC
+                LIMIT 20
+        """,
+        "d.restaurant_id",
+    ),
+    "low_stock": (
+        """
+                SELECT s.restaurant_id, i.name, s.qty, s.min_threshold
+                FROM ingredient_batches s JOIN ingredients i ON i.id = s.ingredient_id
+                WHERE s.qty <= s.min_threshold {and_where}
+        """,
+        "s.restaurant_id",
+    ),
+    "expiring": (
+        """
+                SELECT s.restaurant_id, i.name, s.qty, s.expiry_date
+                FROM ingredient_batches s JOIN ingredients i ON i.id = s.ingredient_id
+                WHERE s.expiry_date IS NOT NULL AND s.expiry_date <= now()::date + INTERVAL '7 days' {and_where}
+        """,
+        "s.restaurant_id",
+    ),
+    "orders_by_status": (
+        "SELECT status, SUM(orders_count)::bigint AS cnt FROM report_orders_daily GROUP BY status",
+        None,
+    ),
+}
+ROLLUP_REPORTS = {"orders_per_restaurant", "top_dishes", "orders_by_status"}
+
+
+def build_report_query(key: str | None, rest: str | int | None) -> tuple[str, list]:
+    if key not in REPORT_QUERIES:
+        raise ValueError("Неизвестный отчет")
+    template, rest_column = REPORT_QUERIES[key]
+    params = []
+    where = and_where = ""
+    if rest and rest_column:
+        where = f"WHERE {rest_column} = %s"
+        and_where = f"AND {rest_column} = %s"
+        params.append(int(rest))
+    return template.format(where=where, and_where=and_where), params
+
+
 @app.post("/action/reports/run")
 @login_required
 def action_reports_run():
@@ -1147,56 +1706,84 @@ def action_reports_run():
         return redirect(url_for("dashboard") + "#tab-reports")
     key = request.form.get("report")
     rest = request.form.get("rest_id") or None
+    if key not in REPORT_QUERIES:
+        flash("Неизвестный отчет", "warning")
+        return redirect(url_for("dashboard") + "#tab-reports")
     try:
-        sql = ""
-        params = []
-        if key == "orders_per_restaurant":
-            sql = "SELECT restaurant_id, COUNT(*) AS orders_count, SUM(total_amount) AS total_amount FROM orders GROUP BY restaurant_id"
-        elif key == "top_dishes":
-            sql = """
-                SELECT d.restaurant_id, d.name, SUM(oi.qty) AS total_qty
-                FROM order_items oi JOIN dishes d ON d.id = oi.dish_id
-                GROUP BY d.restaurant_id, d.name
-                ORDER BY total_qty DESC
-                LIMIT 20
-            """
-        elif key == "low_stock":
-            sql = """
-                SELECT s.restaurant_id, i.name, s.qty, s.min_threshold
-                FROM ingredient_batches s JOIN ingredients i ON i.id = s.ingredient_id
-                WHERE s.qty <= s.min_threshold
-            """
-        elif key == "expiring":
-            sql = """
-                SELECT s.restaurant_id, i.name, s.qty, s.expiry_date
-                FROM ingredient_batches s JOIN ingredients i ON i.id = s.ingredient_id
-                WHERE s.expiry_date IS NOT NULL AND s.expiry_date <= now()::date + INTERVAL '7 days'
-            """
-        elif key == "orders_by_status":
-            sql = "SELECT status, COUNT(*) AS cnt FROM orders GROUP BY status"
-        else:
-            flash("Неизвестный отчет", "warning")
-            return redirect(url_for("dashboard") + "#tab-reports")
-        if rest and "restaurant_id" in sql:
-            if "WHERE" in sql:
-                sql += " AND restaurant_id = %s"
-            else:
-                sql += " WHERE restaurant_id = %s"
-            params.append(int(rest))
+        sql, params = build_report_query(key, rest)
         with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            as_of = refresh_report_rollups(cur) if key in ROLLUP_REPORTS else None
             cur.execute(sql, params)
             rows = cur.fetchall()
             cols = list(rows[0].keys()) if rows else [desc.name for desc in cur.description]
-            session["report_last"] = {"cols": cols, "rows": rows, "key": key}
             rows = format_datetime_columns(rows)
-            session["report_last"] = {"cols": cols, "rows": rows, "key": key}
+            store_result("report_last", cols, rows, key=key, rest_id=rest, as_of=as_of)
     except Exception as ex:
         flash(f"Ошибка отчета: {ex}", "danger")
     return redirect(url_for("dashboard") + "#tab-reports")
 
 
-import csv
-from io import StringIO
+def _export_response(base: str, sql: str, params: list | None = None, header: list[str] | None = None):
+    """Потоковая выгрузка: ?format=csv|ndjson, ?gzip=1 — сжатие на лету."""
+    fmt = request.args.get("format", "csv")
+    compress = request.args.get("gzip") == "1"
+    try:
+        stream = stream_export(sql, params, fmt, compress, header=header)
+    except Exception as ex:
+        return f"Ошибка выгрузки: {ex}", 400
+    return Response(
+        stream_with_context(stream),
+        mimetype=export_mimetype(fmt, compress),
+        headers={"Content-Disposition": f"attachment; filename={export_filename(base, fmt, compress)}"},
+    )
+
+
+@app.get("/api/export/report/<key>")
+@login_required
+def export_report(key):
+    if not has_perm("reports"):
+        return "Доступ запрещён", 403
+    try:
+        sql, params = build_report_query(key, request.args.get("rest_id") or None)
+    except ValueError as ex:
+        return str(ex), 404
+    if key in ROLLUP_REPORTS:
+        with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+            refresh_report_rollups(cur)
+    return _export_response(key, sql, params)
+
+
+@app.get("/api/export/table/<table>")
+@login_required
+def export_table(table):
+    if not has_perm("tables"):
+        return "Доступ запрещён", 403
+    where = request.args.get("where") or None
+    try:
+        _validate_table_query(table, where)
+        sql = f"SELECT * FROM public.{table}"
+        if where:
+            sql += f" WHERE {where}"
+        sql += " ORDER BY 1"
+        _check_generated_sql(sql, None if where else f"{table}:export")
+    except ValueError as ex:
+        return str(ex), 400
+    return _export_response(table, sql)
+
+
+@app.get("/api/export/query")
+@login_required
+def export_query():
+    if not has_perm("query"):
+        return "Доступ запрещён", 403
+    sql = (session.get("query_last") or {}).get("sql")
+    if not sql:
+        return "Нет выполненного запроса", 404
+    # запрос перепроверяется: сессия могла пережить обновление правил guard'а
+    guard_result = validate_sql(sql)
+    if not guard_result["allowed"]:
+        return "Запрос заблокирован правилами безопасности", 400
+    return _export_response("query", sql)
 
 
 @app.route("/api/reports/top_dishes.csv")
@@ -1205,32 +1792,90 @@ def report_top_dishes_csv():
     if not has_perm("reports"):
         return "Доступ запрещён", 403
 
+    sql = """
+        SELECT r.name AS restaurant, d.name AS dish, SUM(x.qty)::bigint AS total
+        FROM report_dish_daily x
+                 JOIN dishes d ON x.dish_id = d.id
+                 JOIN restaurants r ON x.restaurant_id = r.id
+        WHERE x.status = 'completed'
+        GROUP BY r.name, d.name
+        ORDER BY total DESC LIMIT 20
+    """
     with get_db_conn() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("""
-                    SELECT r.name AS restaurant, d.name AS dish, SUM(oi.qty) AS total
-                    FROM order_items oi
-                             JOIN dishes d ON oi.dish_id = d.id
-                             JOIN orders o ON oi.order_id = o.id
-                             JOIN restaurants r ON o.restaurant_id = r.id
-                    WHERE o.status = 'completed'
-                    GROUP BY r.name, d.name
-                    ORDER BY total DESC LIMIT 20;
-                    """)
-        rows = cur.fetchall()
+        refresh_report_rollups(cur)
+    return _export_response("top_dishes", sql, header=["Ресторан", "Блюдо", "Продано"])
+
+
+def chart_watermark(cur, rest_id: int) -> datetime:
+    """Момент, на который актуальны данные ресторана: меняется, когда пересчёт агрегатов затрагивает его дни."""
+    refresh_report_rollups(cur)
+    cur.execute(
+        """
+        SELECT COALESCE(
+            (SELECT changed_at FROM report_restaurant_watermarks WHERE restaurant_id = %s),
+            (SELECT refreshed_at FROM report_refresh_state)
+        ) AS watermark
+        """,
+        (rest_id,),
+    )
+    return cur.fetchone()["watermark"]
 
-    output = StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["Ресторан", "Блюдо", "Продано"])
-    for row in rows:
-        writer.writerow(row.values())
 
-    output.seek(0)
-    return Response(
-        output.getvalue(),
-        mimetype="text/csv",
-        headers={"Content-Disposition": "attachment; filename=top_dishes.csv"}
-    )
+@app.get("/api/charts/<chart>.png")
+@login_required
+def chart_png(chart):
+    # pandas и matplotlib загружаются при первом запросе графика, а не при старте воркера
+    from visualization import RESTAURANT_CHARTS, CHART_STYLE_VERSION, load_chart_specs, render_chart_png
+
+    if not has_perm("reports"):
+        return "Доступ запрещён", 403
+    if chart not in RESTAURANT_CHARTS:
+        return "Неизвестный график", 404
+    rest = request.args.get("rest_id") or current_user().get("restaurant_id")
+    if not str(rest or "").isdigit():
+        return "Не выбран ресторан", 400
+    rest_id = int(rest)
+    date_from = request.args.get("from") or None
+    date_to = request.args.get("to") or None
+    try:
+        for value in (date_from, date_to):
+            if value:
+                datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        return "Неверная дата, нужен формат ГГГГ-ММ-ДД", 400
+
+    cache = get_chart_cache()
+    with get_db_conn() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            watermark = chart_watermark(cur, rest_id)
+        key = (chart, rest_id, date_from, date_to, watermark.isoformat() if watermark else None, CHART_STYLE_VERSION)
+        response = Response(mimetype="image/png")
+        response.set_etag(hashlib.sha256(repr(key).encode("utf-8")).hexdigest()[:32])
+        if watermark:
+            response.last_modified = watermark
+        # браузер всегда переспрашивает, но при неизменных данных получает 304 без отрисовки
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        if response.make_conditional(request).status_code == 304:
+            return response
+
+        png = cache.get(key)
+        specs = None
+        if png is None:
+            specs = load_chart_specs(conn, [str(rest_id)], date_from, date_to, charts=[chart])
+    if png is None:
+        if not specs:
+            return "Нет данных для графика", 404
+        png = render_chart_png(specs[0])
+        cache.put(key, png)
+    response.set_data(png)
+    return response
 
 if __name__ == "__main__":
+    try:
+        print(f"Шаблонов SQL проверено: {register_table_templates()}")
+    except psycopg2.Error as ex:
+        # без БД шаблоны зарегистрируются при первых запросах
+        print(f"Шаблоны SQL не зарегистрированы при старте: {ex}")
     debug_mode = os.environ.get("FLASK_DEBUG", "False").lower() == "true"
     app.run(debug=debug_mode, host="0.0.0.0", port=8000)
\ No newline at end of file